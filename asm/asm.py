@@ -2,9 +2,291 @@
 
 import sys
 import argparse
-import lexparse
+import asyncio
+import concurrent.futures
+import io
+import json
+import multiprocessing
+import os
+import re
 import subprocess
+import time
+import lexparse
 import codegen
+import imagepatch
+import asmc
+
+# output file types: argument name -> (file mode, Codegen method, description)
+OUTPUTS = {
+    'hex':        ('wt', 'output_hex', "hex file"),
+    'hex2':       ('wt', 'output_hex2', "hex file, alternate format"),
+    'out':        ('wb', 'output_binary', "binary"),
+    'compressed': ('wb', 'output_compressed', "compressed binary"),
+    'map':        ('wb', 'output_map', "symbol map"),
+    'flat':       ('wb', 'output_flat', "flat image"),
+}
+
+# don't bother farming out units smaller than this
+PARALLEL_MIN_LINES = 4096
+
+LINE_MARKER = re.compile(r'#\s*(\d+)\s+("(?:[^"\\]|\\.)*")')
+
+# preprocess and assemble a source file, returning the code generator with fixups applied
+def assemble(infile, verbose : int = 0, gc_entry : str | None = None, lines = None, cwd : str | None = None, jobs : int = 1, opt_branches : bool = False, hoist_loops : bool = False) -> codegen.Codegen:
+    code = codegen.Codegen()
+    lexparse.gen = code
+    lexparse.stdin_name = infile.name
+    code.verbose = True if verbose > 1 else False
+
+    # preprocess the assembly, unless the caller already has
+    cpp = None
+    if lines is None:
+        if verbose > 0: print("starting preprocessor")
+        cpp = subprocess.Popen(['cpp','-nostdinc'], stdin=infile, stdout=subprocess.PIPE, text=True, cwd=cwd)
+        lines = cpp.stdout
+
+    # read in the preprocessed assembly and parse it
+    try:
+        # no point in more processes than cpus, on a single cpu just parse serially
+        jobs = min(jobs, os.cpu_count() or 1)
+        parallel = None
+        if jobs > 1:
+            lines = list(lines) # type: ignore
+            if len(lines) >= PARALLEL_MIN_LINES:
+                if verbose > 0: print("starting parser, %d jobs" % jobs)
+                parallel = parse_parallel(lines, jobs, infile.name)
+
+        if parallel is not None:
+            code = parallel
+            code.verbose = True if verbose > 1 else False
+        else:
+            if verbose > 0: print("starting parser")
+            for line in lines: # type: ignore
+                if verbose > 1: print("parsing line: ", line, end='')
+                lexparse.yacc.parse(line, debug=False)
+    finally:
+        if cpp is not None:
+            cpp.stdout.close() # type: ignore
+            cpp.wait()
+
+    if gc_entry is not None:
+        if verbose > 0: print("removing unreferenced code and data")
+        for name, addr, length in code.gc(gc_entry):
+            print("gc: removed %s at 0x%04x, %d bytes" % (name, addr, length * 2))
+
+    if opt_branches:
+        if verbose > 0: print("optimizing branches")
+        print(code.optimize_branches())
+
+    if hoist_loops:
+        if verbose > 0: print("hoisting loop constants")
+        print(code.hoist_loop_constants())
+
+    if verbose > 0: print("processing fixups")
+    code.handle_fixups()
+
+    return code
+
+# cut preprocessed lines into chunks that can be parsed independently. every
+# line is a complete statement, so any line boundary will do, but each chunk
+# after the first gets a line marker so source locations carry on correctly
+def split_lines(lines : list[str], count : int) -> list[list[str]]:
+    size = -(-len(lines) // count)
+    chunks = []
+    start = 0
+    cur_line = 0
+    cur_file = None
+    marker = []
+    for i, line in enumerate(lines):
+        if i > start and (i - start) >= size:
+            chunks.append(marker + lines[start:i])
+            marker = [ '# %d %s\n' % (cur_line, cur_file) ] if cur_file is not None else []
+            start = i
+
+        m = LINE_MARKER.match(line) if line.startswith('#') else None
+        if m is not None:
+            cur_line = int(m.group(1))
+            cur_file = m.group(2)
+        else:
+            cur_line += 1
+    chunks.append(marker + lines[start:])
+    return chunks
+
+# worker side of parse_parallel, returns the chunk as a fragment assembled at address 0
+def parse_chunk(lines : list[str], stdin_name : str) -> codegen.Codegen:
+    code = codegen.Codegen()
+    lexparse.gen = code
+    lexparse.stdin_name = stdin_name
+    for line in lines:
+        lexparse.yacc.parse(line, debug=False)
+    return code
+
+# parse a preprocessed unit in a process pool and link the pieces back together.
+# returns None if the unit can't be split, e.g. a label is defined twice
+def parse_parallel(lines : list[str], jobs : int, stdin_name : str) -> codegen.Codegen | None:
+    chunks = split_lines(lines, jobs)
+    with concurrent.futures.ProcessPoolExecutor(jobs, mp_context=multiprocessing.get_context('fork')) as pool:
+        frags = list(pool.map(parse_chunk, chunks, [ stdin_name ] * len(chunks)))
+
+    code = codegen.Codegen()
+    try:
+        for frag in frags:
+            code.link(frag)
+    except codegen.Codegen_Exception:
+        return None
+
+    lexparse.gen = code
+    return code
+
+def write_output(code : codegen.Codegen, kind : str, outfile, verbose : int = 0):
+    mode, method, desc = OUTPUTS[kind]
+    if verbose > 0: print("outputting %s" % desc)
+    getattr(code, method)(outfile)
+    outfile.close()
+
+# keeps the preprocessor out of the way for sources that don't need it
+class Preprocessor:
+    def __init__(self) -> None:
+        # macros cpp defines on its own, e.g. 'linux' and 'unix'
+        out = subprocess.run(['cpp','-nostdinc','-dM'], stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, text=True).stdout
+        self.predefined = { l.split()[1].split('(')[0] for l in out.splitlines() if l.startswith('#define ') }
+
+    # returns the preprocessed lines of a source file
+    def run(self, path : str, cwd : str | None = None) -> list[str]:
+        with open(path) as f:
+            text = f.read()
+
+        # with no directives, comments or predefined macros to deal with, cpp
+        # would hand back the source unchanged, so skip the fork
+        if not any(c in text for c in ('#', '/*', '\\', '??')) and \
+           self.predefined.isdisjoint(re.findall(r'[A-Za-z_]\w*', text)):
+            return [ '# 1 "<stdin>"\n' ] + [ l + '\n' for l in text.split('\n') ]
+
+        with open(path) as f:
+            out = subprocess.run(['cpp','-nostdinc'], stdin=f, stdout=subprocess.PIPE, text=True, cwd=cwd).stdout
+        return out.splitlines(keepends=True)
+
+# assembles on request, reusing the previous result if no source file changed
+class Builder:
+    def __init__(self, verbose : int = 0, jobs : int = 1) -> None:
+        self.verbose = verbose
+        self.jobs = jobs
+        self.pre = Preprocessor()
+        self.cache : dict[tuple[str, str | None, bool, bool], tuple[list[tuple[str, int, int]], codegen.Codegen]] = {}
+
+    def deps_state(self, files : list[str], cwd : str) -> list[tuple[str, int, int]]:
+        state = []
+        for f in files:
+            path = os.path.join(cwd, f)
+            try:
+                st = os.stat(path)
+                state.append((path, st.st_mtime_ns, st.st_size))
+            except OSError:
+                state.append((path, 0, -1))
+        return state
+
+    def build(self, path : str, gc_entry : str | None = None, cwd : str | None = None,
+              opt_branches : bool = False, hoist_loops : bool = False) -> tuple[codegen.Codegen, bool]:
+        cwd = cwd or os.getcwd()
+        path = os.path.join(cwd, path)
+        key = (path, gc_entry, opt_branches, hoist_loops)
+
+        cached = self.cache.get(key)
+        if cached is not None and self.deps_state([ d[0] for d in cached[0] ], cwd) == cached[0]:
+            return (cached[1], False)
+
+        lines = self.pre.run(path, cwd)
+        with open(path) as f:
+            code = assemble(f, self.verbose, gc_entry, lines, cwd, self.jobs, opt_branches, hoist_loops)
+        self.cache[key] = (self.deps_state(code.files or [ path ], cwd), code)
+        return (code, True)
+
+# long lived assembler, serving requests from asmc.py on a unix socket
+def serve(sock_path : str, verbose : int = 0, jobs : int = 1):
+    builder = Builder(jobs=jobs)
+
+    async def handle(reader : asyncio.StreamReader, writer : asyncio.StreamWriter):
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+
+            start = time.perf_counter()
+            msgs = io.StringIO()
+            try:
+                req = json.loads(line)
+                cwd = req.get('cwd') or os.getcwd()
+
+                # the parser reports errors on stdout, send them back to the client
+                stdout = sys.stdout
+                sys.stdout = msgs
+                try:
+                    code, rebuilt = builder.build(req['source'], req.get('gc'), cwd,
+                                                  bool(req.get('opt_branches')), bool(req.get('hoist_loops')))
+                    for kind, path in req.get('outputs', {}).items():
+                        if kind not in OUTPUTS:
+                            raise asmc.ProtocolError("unknown output type '%s'" % kind)
+                        write_output(code, kind, open(os.path.join(cwd, path), OUTPUTS[kind][0]))
+                finally:
+                    sys.stdout = stdout
+                resp = { 'ok': True, 'rebuilt': rebuilt }
+            except Exception as e:
+                resp = { 'ok': False, 'error': "%s: %s" % (type(e).__name__, str(e)) }
+            resp['messages'] = msgs.getvalue()
+            resp['time'] = time.perf_counter() - start
+            if verbose > 0: print("request %s: %s in %.3f ms" % (line.decode().strip(), 'ok' if resp['ok'] else resp['error'], resp['time'] * 1e3))
+
+            writer.write(json.dumps(resp).encode() + b'\n')
+            await writer.drain()
+        writer.close()
+
+    async def run():
+        if os.path.exists(sock_path):
+            os.unlink(sock_path)
+        server = await asyncio.start_unix_server(handle, path=sock_path)
+        print("serving on %s" % sock_path)
+        async with server:
+            await server.serve_forever()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if os.path.exists(sock_path):
+            os.unlink(sock_path)
+
+# rebuild the outputs whenever the source or anything it includes changes
+def watch(path : str, outputs : dict[str, str], gc_entry : str | None, interval : float, verbose : int = 0,
+          jobs : int = 1, opt_branches : bool = False, hoist_loops : bool = False):
+    builder = Builder(verbose, jobs)
+    cwd = os.getcwd()
+    first = True
+    failed : list[tuple[str, int, int]] | None = None
+    try:
+        while True:
+            # after a failed build, wait for one of the files involved to change
+            if failed is not None and builder.deps_state([ d[0] for d in failed ], cwd) == failed:
+                time.sleep(interval)
+                continue
+            failed = None
+
+            try:
+                start = time.perf_counter()
+                code, rebuilt = builder.build(path, gc_entry, cwd, opt_branches, hoist_loops)
+                if rebuilt:
+                    for kind, out in outputs.items():
+                        write_output(code, kind, open(out, OUTPUTS[kind][0]))
+                    print("%s %s in %.1f ms" % ("built" if first else "rebuilt", path, (time.perf_counter() - start) * 1e3))
+                    first = False
+            except Exception as e:
+                # keep watching, the next save will probably fix it
+                print("%s: %s" % (type(e).__name__, str(e)))
+                failed = builder.deps_state([ path ] + lexparse.gen.files, cwd)
+
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
 
 def main():
 
@@ -14,27 +296,51 @@ def main():
     parser.add_argument('-o','--out', nargs=1, type=argparse.FileType('wb', 0), help="output binary")
     parser.add_argument('-x','--hex', nargs=1, type=argparse.FileType('wt', 1), help="output hex file")
     parser.add_argument('-X','--hex2', nargs=1, type=argparse.FileType('wt', 1), help="output hex file, alternate format")
+    parser.add_argument('-z','--compressed', nargs=1, type=argparse.FileType('wb', 0), help="output compressed binary")
+    parser.add_argument('-m','--map', nargs=1, type=argparse.FileType('wb', 0), help="output symbol and source line map")
+    parser.add_argument('-F','--flat', nargs=1, type=argparse.FileType('wb', 0), help="output flat memory image")
+    parser.add_argument('-p','--patch', nargs=1, type=argparse.FileType('wb', 0), help="output patch file, requires --diff-against")
+    parser.add_argument('--diff-against', nargs=1, type=argparse.FileType('rb'), metavar='OLD', help="previous binary image to generate the patch against")
+    parser.add_argument('-j','--jobs', type=int, default=1, help="parse large sources in parallel with this many processes, at most one per cpu")
+    parser.add_argument('--gc', nargs='?', const='start', metavar='ENTRY', help="remove code and data not reachable from ENTRY (default start)")
+    parser.add_argument('--opt-branches', action='store_true', help="thread branches and lay out blocks to fall through")
+    parser.add_argument('--hoist-loops', action='store_true', help="load wide immediates used in loops into free registers before the loop")
+    parser.add_argument('--serve', nargs='?', const=asmc.DEFAULT_SOCKET, metavar='SOCKET', help="run as a server for asmc.py on a unix socket (default %s)" % asmc.DEFAULT_SOCKET)
+    parser.add_argument('--watch', action='store_true', help="keep running, rebuilding the outputs when the source or its includes change")
+    parser.add_argument('--interval', type=float, default=0.2, help="polling interval for --watch, in seconds")
     parser.add_argument('-v','--verbose', action='count', default=0, help="verbose output")
 
     args = parser.parse_args()
     #print(args)
 
-    code = codegen.Codegen()
-    lexparse.gen = code
-    code.verbose = True if args.verbose > 1 else False
+    if (args.patch is None) != (args.diff_against is None):
+        parser.error("--patch and --diff-against must be used together")
 
-    # preprocess the assembly
-    if args.verbose > 0: print("starting preprocessor")
-    cpp = subprocess.Popen(['cpp','-nostdinc'], stdin=args.infile, stdout=subprocess.PIPE, text=True)
+    if args.serve is not None:
+        # the server takes these per request, from asmc.py
+        if args.gc is not None or args.opt_branches or args.hoist_loops:
+            parser.error("--gc, --opt-branches and --hoist-loops are per request with --serve, pass them to asmc.py")
+        serve(args.serve, args.verbose, args.jobs)
+        return
 
-    # read in the preprocessed assembly and parse it
-    if args.verbose > 0: print("starting parser")
-    for line in cpp.stdout: # type: ignore
-        if args.verbose > 1: print("parsing line: ", line, end='')
-        lexparse.yacc.parse(line, debug=False)
+    if args.watch:
+        if args.infile is sys.stdin:
+            parser.error("--watch needs an input file")
+        if args.patch is not None:
+            parser.error("--watch can't be used with --patch")
 
-    if args.verbose > 0: print("processing fixups")
-    code.handle_fixups()
+        # the output files were opened by the argument parser, reopen them on every rebuild
+        outputs = {}
+        for kind in OUTPUTS:
+            f = getattr(args, kind)
+            if f is not None:
+                outputs[kind] = f[0].name
+                f[0].close()
+        args.infile.close()
+        watch(args.infile.name, outputs, args.gc, args.interval, args.verbose, args.jobs, args.opt_branches, args.hoist_loops)
+        return
+
+    code = assemble(args.infile, args.verbose, args.gc, jobs=args.jobs, opt_branches=args.opt_branches, hoist_loops=args.hoist_loops)
 
     if args.verbose > 0:
         print("dumping instructions/data:")
@@ -42,20 +348,24 @@ def main():
         print("dumping symbols:")
         code.dump_symbols()
 
-    if args.hex is not None:
-        if args.verbose > 0: print("outputting hex file")
-        code.output_hex(args.hex[0])
-        args.hex[0].close()
+    for kind in OUTPUTS:
+        f = getattr(args, kind)
+        if f is not None:
+            write_output(code, kind, f[0], args.verbose)
+
+    if args.patch is not None:
+        if args.verbose > 0: print("outputting patch")
+        old = imagepatch.read_image(args.diff_against[0])
+        new = code.image()
+        patch = imagepatch.make_patch(old, new)
 
-    if args.hex2 is not None:
-        if args.verbose > 0: print("outputting hex file, alternate format")
-        code.output_hex2(args.hex2[0])
-        args.hex2[0].close()
+        # make sure the patch round trips before handing it out
+        if imagepatch.apply_patch(old, patch) != new:
+            raise imagepatch.PatchError("patch does not reproduce the new image")
 
-    if args.out is not None:
-        if args.verbose > 0: print("outputting binary")
-        code.output_binary(args.out[0])
-        args.out[0].close()
+        if args.verbose > 0: print("patch is %d bytes for a %d byte image" % (len(patch), len(new) * 2))
+        args.patch[0].write(patch)
+        args.patch[0].close()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+# thin client for a long lived assembler started with 'asm.py --serve'
+#
+# takes the same output options as asm.py, but only imports the standard
+# library so it starts quickly, and leaves the work to the server.
+#
+# protocol: one json object per line in each direction.
+#   request:  {"source": path, "cwd": dir, "outputs": {kind: path}, "gc": entry or null,
+#              "opt_branches": bool, "hoist_loops": bool}
+#             kind is one of hex, hex2, out, compressed, map, flat
+#   response: {"ok": bool, "rebuilt": bool, "error": str, "messages": str, "time": seconds}
+
+import argparse
+import json
+import os
+import socket
+import sys
+
+DEFAULT_SOCKET = os.environ.get('ASM_SOCKET', '/tmp/2stage-asm-%d.sock' % os.getuid())
+
+class ProtocolError(Exception):
+    pass
+
+class Client:
+    def __init__(self, sock_path : str = DEFAULT_SOCKET) -> None:
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(sock_path)
+        self.reader = self.sock.makefile('rb')
+
+    def assemble(self, source : str, outputs : dict[str, str], gc_entry : str | None = None,
+                 opt_branches : bool = False, hoist_loops : bool = False) -> dict:
+        req = { 'source': source, 'cwd': os.getcwd(), 'outputs': outputs, 'gc': gc_entry,
+                'opt_branches': opt_branches, 'hoist_loops': hoist_loops }
+        self.sock.sendall(json.dumps(req).encode() + b'\n')
+        line = self.reader.readline()
+        if not line:
+            raise ProtocolError("server closed the connection")
+        return json.loads(line)
+
+    def close(self):
+        self.reader.close()
+        self.sock.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="assemble using a server started with asm.py --serve")
+    parser.add_argument('infile', help="input file")
+    parser.add_argument('-o','--out', help="output binary")
+    parser.add_argument('-x','--hex', help="output hex file")
+    parser.add_argument('-X','--hex2', help="output hex file, alternate format")
+    parser.add_argument('-z','--compressed', help="output compressed binary")
+    parser.add_argument('-m','--map', help="output symbol and source line map")
+    parser.add_argument('-F','--flat', help="output flat memory image")
+    parser.add_argument('--gc', nargs='?', const='start', metavar='ENTRY', help="remove code and data not reachable from ENTRY (default start)")
+    parser.add_argument('--opt-branches', action='store_true', help="thread branches and lay out blocks to fall through")
+    parser.add_argument('--hoist-loops', action='store_true', help="load wide immediates used in loops into free registers before the loop")
+    parser.add_argument('-S','--socket', default=DEFAULT_SOCKET, help="server socket (default %s)" % DEFAULT_SOCKET)
+    parser.add_argument('-v','--verbose', action='count', default=0, help="verbose output")
+
+    args = parser.parse_args()
+
+    outputs = {}
+    for kind in ('hex', 'hex2', 'out', 'compressed', 'map', 'flat'):
+        if getattr(args, kind) is not None:
+            outputs[kind] = getattr(args, kind)
+
+    client = Client(args.socket)
+    resp = client.assemble(args.infile, outputs, args.gc, args.opt_branches, args.hoist_loops)
+    client.close()
+
+    if resp.get('messages'):
+        print(resp['messages'], end='')
+    if args.verbose > 0:
+        print("%s in %.3f ms" % ("assembled" if resp.get('rebuilt') else "up to date", resp['time'] * 1e3))
+    if not resp['ok']:
+        print(resp['error'], file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
+
+# vim: ts=4 sw=4 expandtab:
@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+
+# benchmarks for the assembler and its image formats
+#
+# run from anywhere, e.g.
+#   asm/bench.py compress
+
+import argparse
+import array
+import glob
+import io
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+import asm
+import asmc
+import codegen
+import compress
+import flatimage
+import symmap
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+
+def src_images() -> list[tuple[str, array.array]]:
+    images = []
+    for path in sorted(glob.glob(os.path.join(SRC_DIR, '*.asm'))):
+        with open(path) as f:
+            code = asm.assemble(f)
+        images.append((os.path.basename(path), code.image()))
+    return images
+
+# a 60K word image that looks roughly like a real program: runs of code built
+# from a small set of instruction forms, ascii tables and zero filled buffers
+def synthetic_image(words : int = 60 * 1024, seed : int = 1) -> array.array:
+    rng = random.Random(seed)
+    forms = [ rng.randrange(0x10000) for _ in range(300) ]
+    image = array.array('H')
+    while len(image) < words:
+        kind = rng.random()
+        if kind < 0.6:
+            for _ in range(rng.randrange(8, 200)):
+                image.append(rng.choice(forms))
+                if rng.random() < 0.15:
+                    image.append(rng.randrange(0x10000))
+        elif kind < 0.8:
+            text = ''.join(rng.choice('etaoin shrdlu') for _ in range(rng.randrange(8, 120)))
+            image.extend(ord(c) for c in text)
+            image.append(0)
+        else:
+            image.extend([0] * rng.randrange(16, 1024))
+    del image[words:]
+    return image
+
+def timeit(fn, min_time : float = 0.2) -> float:
+    runs = 0
+    start = time.perf_counter()
+    while True:
+        fn()
+        runs += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            return elapsed / runs
+
+def bench_compress(args):
+    images = src_images()
+    images.append(('synthetic 60K', synthetic_image()))
+
+    print("%-16s %8s %8s %7s %12s" % ("image", "bytes", "packed", "ratio", "decode MB/s"))
+    for name, image in images:
+        packed = compress.compress(image)
+        if compress.decompress(packed) != image:
+            raise compress.CompressError("%s does not round trip" % name)
+
+        # feed the decoder in serial sized chunks to exercise the streaming path
+        def decode():
+            d = compress.Decoder()
+            for i in range(0, len(packed), 256):
+                d.feed(packed[i:i + 256])
+
+        t = timeit(decode)
+        raw = len(image) * 2
+        print("%-16s %8d %8d %6.2fx %12.2f" % (name, raw, len(packed), raw / len(packed), raw / t / 1e6))
+
+# a 60K word program with a label every few instructions
+def synthetic_program(words : int = 60 * 1024, seed : int = 1) -> codegen.Codegen:
+    rng = random.Random(seed)
+    code = codegen.Codegen()
+    code.cur_file = "synthetic.asm"
+    n = 0
+    while code.cur_addr < words:
+        n += 1
+        code.cur_line = n
+        if rng.random() < 0.2:
+            code.add_label("L%d" % n)
+        elif rng.random() < 0.1:
+            code.add_instruction('mov', (('REGISTER', rng.randrange(1, 8)), ('NUMBER', rng.randrange(0x10000))))
+        else:
+            code.add_instruction('add', (('REGISTER', rng.randrange(1, 8)), ('REGISTER', rng.randrange(1, 8))))
+    code.handle_fixups()
+    return code
+
+def bench_symbols(args):
+    code = synthetic_program()
+    buf = io.BytesIO()
+    code.output_map(buf)
+
+    with tempfile.NamedTemporaryFile(suffix='.map') as f:
+        f.write(buf.getvalue())
+        f.flush()
+
+        start = time.perf_counter()
+        m = symmap.SymbolMap.open(f.name)
+        opened = time.perf_counter() - start
+
+        rng = random.Random(2)
+        addrs = [ rng.randrange(code.cur_addr) for _ in range(1000000) ]
+
+        start = time.perf_counter()
+        for a in addrs:
+            m.lookup(a)
+        t_sym = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for a in addrs:
+            m.source(a)
+        t_line = time.perf_counter() - start
+
+    print("map %d bytes, %d symbols, %d line entries, opened in %.1f us" % (
+          len(buf.getvalue()), len(m.sym_addr), len(m.line_addr), opened * 1e6))
+    print("1M symbol lookups %.3f s (%.2f M/s)" % (t_sym, 1 / t_sym))
+    print("1M line lookups   %.3f s (%.2f M/s)" % (t_line, 1 / t_line))
+
+# a 60K instruction stream built from a few hundred distinct instruction forms
+def repetitive_source(count : int = 60 * 1024, seed : int = 1) -> list[tuple[str, tuple]]:
+    rng = random.Random(seed)
+    forms = []
+    alu = [ 'mov', 'add', 'adc', 'sub', 'and', 'or', 'xor', 'lsl', 'ldr', 'str', 'cmp' ]
+    for _ in range(300):
+        ins = rng.choice(alu)
+        d = ('REGISTER', rng.randrange(1, 8))
+        if ins in ('mov', 'cmp'):
+            args = (d, ('NUMBER', rng.choice([ 0, 1, 4, 0x100, 0xf000 ])))
+        elif rng.random() < 0.5:
+            args = (d, ('REGISTER', rng.randrange(1, 8)), ('NUMBER', rng.choice([ 0, 1, 4, 0x100, 0xf000 ])))
+        else:
+            args = (d, ('REGISTER', rng.randrange(1, 8)))
+        forms.append((ins, args))
+    return [ rng.choice(forms) for _ in range(count) ]
+
+# codegen.py as it was at a git revision, loaded as a module of its own
+def revision_codegen(rev : str) -> types.ModuleType:
+    here = os.path.dirname(os.path.abspath(__file__))
+    source = subprocess.run([ 'git', 'show', '%s:./codegen.py' % rev ], cwd=here, check=True,
+                            stdout=subprocess.PIPE).stdout
+    module = types.ModuleType('codegen_%s' % rev)
+    exec(compile(source, 'codegen.py@%s' % rev, 'exec'), module.__dict__)
+    return module
+
+def bench_encode(args):
+    source = repetitive_source()
+
+    def assemble(gen = codegen):
+        code = gen.Codegen()
+        for ins, a in source:
+            code.add_instruction(ins, a)
+        return code
+
+    results = []
+    if args.baseline is not None:
+        base = revision_codegen(args.baseline)
+        expected = [ (i.op, i.op2, i.length, i.string) for i in assemble().output ]
+        if [ (i.op, i.op2, i.length, i.string) for i in assemble(base).output ] != expected:
+            raise codegen.Codegen_Exception("codegen.py at %s encodes differently" % args.baseline)
+        results.append(("codegen.py at %s" % args.baseline, timeit(lambda: assemble(base), 1.0)))
+
+    memo = codegen.encode_instruction
+    try:
+        codegen.encode_instruction = memo.__wrapped__
+        results.append(("compiled encoders", timeit(assemble, 1.0)))
+    finally:
+        codegen.encode_instruction = memo
+    memo.cache_clear()
+    results.append(("compiled encoders + memo", timeit(assemble, 1.0)))
+
+    n = len(source)
+    print("%d instructions, %d distinct forms" % (n, len(set(source))))
+    for name, t in results:
+        print("  %-27s %8.1f ms  %6.2f M ins/s  %5.2fx" % (name, t * 1e3, n / t / 1e6, results[0][1] / t))
+
+def bench_serve(args):
+    here = os.path.dirname(os.path.abspath(__file__))
+    runs = 10
+
+    with tempfile.TemporaryDirectory() as tmp:
+        src = os.path.join(tmp, 'uart.asm')
+        out = os.path.join(tmp, 'uart.bin')
+        sock = os.path.join(tmp, 'asm.sock')
+        shutil.copy(os.path.join(SRC_DIR, 'uart.asm'), src)
+
+        def touch():
+            st = os.stat(src)
+            os.utime(src, ns=(st.st_atime_ns, st.st_mtime_ns + 1000))
+
+        def run(cmd : list[str]) -> float:
+            start = time.perf_counter()
+            subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL)
+            return time.perf_counter() - start
+
+        cold = sum(run([ sys.executable, os.path.join(here, 'asm.py'), '-o', out, src ]) for _ in range(runs)) / runs
+
+        server = subprocess.Popen([ sys.executable, os.path.join(here, 'asm.py'), '--serve', sock ], stdout=subprocess.DEVNULL)
+        try:
+            while not os.path.exists(sock):
+                time.sleep(0.01)
+
+            client_cmd = [ sys.executable, os.path.join(here, 'asmc.py'), '-S', sock, '-o', out, src ]
+            run(client_cmd)
+            client_cached = sum(run(client_cmd) for _ in range(runs)) / runs
+            client_rebuild = 0.0
+            for _ in range(runs):
+                touch()
+                client_rebuild += run(client_cmd)
+            client_rebuild /= runs
+
+            c = asmc.Client(sock)
+            start = time.perf_counter()
+            for _ in range(runs * 10):
+                c.assemble(src, { 'out': out })
+            req_cached = (time.perf_counter() - start) / (runs * 10)
+            start = time.perf_counter()
+            for _ in range(runs * 10):
+                touch()
+                c.assemble(src, { 'out': out })
+            req_rebuild = (time.perf_counter() - start) / (runs * 10)
+            c.close()
+        finally:
+            server.terminate()
+            server.wait()
+
+    print("uart.asm, mean of %d runs" % runs)
+    print("  cold asm.py                       %8.2f ms" % (cold * 1e3))
+    print("  asmc.py, source changed           %8.2f ms" % (client_rebuild * 1e3))
+    print("  asmc.py, up to date               %8.2f ms" % (client_cached * 1e3))
+    print("  in process request, changed       %8.3f ms" % (req_rebuild * 1e3))
+    print("  in process request, up to date    %8.3f ms" % (req_cached * 1e3))
+
+def bench_load(args):
+    code = synthetic_program()
+    image = code.image()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        hexpath = os.path.join(tmp, 'synthetic.hex')
+        flatpath = os.path.join(tmp, 'synthetic.flat')
+        with open(hexpath, 'w') as f:
+            code.output_hex(f)
+        with open(flatpath, 'wb') as f:
+            code.output_flat(f)
+
+        # what the tools do with a hex file today: the first field of every line is a word
+        def parse_hex() -> array.array:
+            words = array.array('H')
+            with open(hexpath) as f:
+                for line in f:
+                    words.append(int(line.split(None, 1)[0], 16))
+            return words
+
+        if parse_hex() != image or flatimage.FlatImage.open(flatpath).words()[:len(image)] != image:
+            raise flatimage.FlatImageError("loaded images don't match")
+
+        # every row ends up with all the words in hand, mapping the file alone doesn't
+        # touch a page, so it isn't a load
+        results = [
+            ("parse .hex", timeit(parse_hex)),
+            ("flat image, words()", timeit(lambda: flatimage.FlatImage.open(flatpath).words())),
+        ]
+        if flatimage.numpy is not None:
+            results.append(("flat image, numpy view + sum", timeit(lambda: int(flatimage.FlatImage.open(flatpath).view().sum()))))
+
+        print("%d word image, .hex %d bytes, flat %d bytes" % (len(image), os.path.getsize(hexpath), os.path.getsize(flatpath)))
+        for name, t in results:
+            print("  %-30s %10.1f us  %8.1fx" % (name, t * 1e6, results[0][1] / t))
+        if flatimage.numpy is None:
+            print("  numpy not installed, skipped the numpy view")
+        print("  header and mmap only, no words read  %.1f us" % (timeit(lambda: flatimage.FlatImage.open(flatpath)) * 1e6))
+
+def main():
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest='bench', required=True)
+    sub.add_parser('compress', help="compression ratio and decode throughput").set_defaults(func=bench_compress)
+    sub.add_parser('symbols', help="symbol map lookups on a 60K word image").set_defaults(func=bench_symbols)
+    p = sub.add_parser('encode', help="instruction encode throughput")
+    p.add_argument('--baseline', metavar='REV', help="also time codegen.py as of this git revision")
+    p.set_defaults(func=bench_encode)
+    sub.add_parser('serve', help="cold vs warm assembler latency").set_defaults(func=bench_serve)
+    sub.add_parser('load', help="loading a flat image vs parsing .hex").set_defaults(func=bench_load)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
+
+# vim: ts=4 sw=4 expandtab:
@@ -0,0 +1,267 @@
+# branch threading and block layout
+#
+# works on the label delimited regions of a Codegen before fixups are applied,
+# while every branch still refers to its target by symbol:
+#
+#   threading   a branch to a 'b X' goes straight to X instead
+#   layout      a block only ever entered by a jump, which itself ends in a jump,
+#               is moved to sit right after a region ending in 'b block', and
+#               that b is dropped so the path falls through
+#   inversion   'bCC L1; b L2; L1:' becomes 'bNCC L2; L1:'
+#   cleanup     a b to the very next address is dropped
+#
+# anything that changes addresses is skipped if the program has pc relative
+# branches with immediate offsets, since those can't follow the code around.
+
+from codegen import Codegen, Instruction, OutputData, Symbol, FIXUP_TYPE, \
+    opcode_table, ITYPE, is_unconditional_branch, branch_target
+
+SHORT_MIN = -256
+SHORT_MAX = 255
+
+# condition code -> mnemonic, for rewriting the text of inverted branches
+CONDITION_NAMES : dict[int, str] = {}
+for _name, _fmt in opcode_table.items():
+    if _fmt.itype == ITYPE.SHORT_BRANCH:
+        CONDITION_NAMES.setdefault((_fmt.opcode >> 10) & 0xf, _name)
+
+class BranchReport:
+    def __init__(self) -> None:
+        self.retargeted = 0
+        self.moved = 0
+        self.inverted = 0
+        self.removed = 0
+        self.words_removed = 0
+
+    # every removed b or inverted pair is one less taken branch on that path
+    def taken_removed(self) -> int:
+        return self.removed + self.inverted
+
+    def __str__(self):
+        return "branches: %d retargeted, %d blocks moved, %d inverted, %d removed, " \
+               "%d taken branches and %d words removed" % (
+               self.retargeted, self.moved, self.inverted, self.removed,
+               self.taken_removed(), self.words_removed)
+
+def is_jump(out : OutputData) -> bool:
+    # plain b to a label
+    return isinstance(out, Instruction) and out.fixup_type == FIXUP_TYPE.LONG_BRANCH and \
+           is_unconditional_branch(out) and out.fixup_sym is not None and out.fixup_sym.resolved
+
+def is_cond_branch(out : OutputData) -> bool:
+    return isinstance(out, Instruction) and out.fixup_type == FIXUP_TYPE.SHORT_BRANCH and \
+           ((out.op >> 10) & 0xf) < 0b1110 and out.fixup_sym is not None and out.fixup_sym.resolved
+
+class BranchOptimizer:
+    def __init__(self, code : Codegen) -> None:
+        self.code = code
+        self.report = BranchReport()
+
+        self.bounds, self.regions = code.split_regions()
+        self.region_index = { addr: i for i, addr in enumerate(self.bounds) }
+
+        # current region order, as a doubly linked list
+        n = len(self.regions)
+        self.prev : list[int] = [ i - 1 for i in range(n) ]
+        self.next : list[int] = [ i + 1 if i + 1 < n else -1 for i in range(n) ]
+
+        # layout, filled in by relayout()
+        self.region_addr : list[int] = [ 0 ] * n
+        self.end = 0
+
+    def region_of(self, sym : Symbol) -> int:
+        return self.region_index[sym.addr]
+
+    # first output reached by jumping to a region, skipping empty alias regions
+    def first_at(self, r : int) -> OutputData | None:
+        while r >= 0:
+            if self.regions[r]:
+                return self.regions[r][0]
+            r = self.next[r]
+        return None
+
+    def final_target(self, sym : Symbol) -> Symbol:
+        seen = { sym.name }
+        while True:
+            first = self.first_at(self.region_of(sym))
+            if first is None or not is_jump(first) or first.fixup_sym.name in seen: # type: ignore
+                return sym
+            sym = first.fixup_sym # type: ignore
+            seen.add(sym.name)
+
+    def order(self):
+        r = 0
+        while r >= 0:
+            yield r
+            r = self.next[r]
+
+    def relayout(self):
+        addr = 0
+        for r in self.order():
+            self.region_addr[r] = addr
+            for out in self.regions[r]:
+                out.addr = addr
+                addr += out.length
+        self.end = addr
+
+    def sym_addr(self, sym : Symbol) -> int:
+        return self.region_addr[self.region_of(sym)]
+
+    def short_in_range(self, out : OutputData, sym : Symbol) -> bool:
+        offset = self.sym_addr(sym) - (out.addr + 1)
+        return SHORT_MIN <= offset <= SHORT_MAX
+
+    def all_short_in_range(self) -> bool:
+        for r in self.order():
+            for out in self.regions[r]:
+                if out.fixup_type == FIXUP_TYPE.SHORT_BRANCH and out.fixup_sym is not None and \
+                   out.fixup_sym.resolved and not self.short_in_range(out, out.fixup_sym):
+                    return False
+        return True
+
+    def unlink(self, r : int):
+        p, n = self.prev[r], self.next[r]
+        self.next[p] = n
+        if n >= 0:
+            self.prev[n] = p
+
+    def insert_after(self, r : int, after : int):
+        n = self.next[after]
+        self.prev[r] = after
+        self.next[r] = n
+        self.next[after] = r
+        if n >= 0:
+            self.prev[n] = r
+
+    def retarget(self, out : OutputData, sym : Symbol):
+        out.fixup_sym = sym
+        out.string = "%s %s" % (out.string.split()[0], sym.name)
+        self.report.retargeted += 1
+
+    def remove(self, r : int, out : OutputData):
+        self.regions[r].remove(out)
+        self.report.words_removed += out.length
+
+    # point long branches past any chain of b's
+    def thread_long(self):
+        for outs in self.regions:
+            for out in outs:
+                if out.fixup_type != FIXUP_TYPE.LONG_BRANCH or out.fixup_sym is None or not out.fixup_sym.resolved:
+                    continue
+                target = self.final_target(out.fixup_sym)
+                if target is not out.fixup_sym:
+                    self.retarget(out, target)
+
+    # same for conditional branches, as long as the final target is still in reach
+    def thread_short(self):
+        for r in self.order():
+            for out in self.regions[r]:
+                if not is_cond_branch(out):
+                    continue
+                target = self.final_target(out.fixup_sym) # type: ignore
+                if target is not out.fixup_sym and self.short_in_range(out, target):
+                    self.retarget(out, target)
+
+    def movable(self, b : int) -> bool:
+        outs = self.regions[b]
+        if b == 0 or not outs or not is_unconditional_branch(outs[-1]):
+            return False
+        # nothing may fall into it
+        p = self.prev[b]
+        return bool(self.regions[p]) and is_unconditional_branch(self.regions[p][-1])
+
+    def layout_blocks(self):
+        moves = []
+        moved = set()
+        for a in range(len(self.regions)):
+            outs = self.regions[a]
+            if not outs or not is_jump(outs[-1]):
+                continue
+            b = self.region_of(outs[-1].fixup_sym) # type: ignore
+            if b == a or b == self.next[a] or b in moved or not self.movable(b):
+                continue
+
+            jump = outs[-1]
+            moves.append((a, b, self.prev[b], jump))
+            moved.add(b)
+            self.unlink(b)
+            self.insert_after(b, a)
+            outs.pop()
+
+        # moving blocks around can push short branches out of reach, back
+        # out the most recent moves until everything fits again
+        self.relayout()
+        while moves and not self.all_short_in_range():
+            a, b, p, jump = moves.pop()
+            self.unlink(b)
+            self.insert_after(b, p)
+            self.regions[a].append(jump)
+            self.relayout()
+
+        for a, b, p, jump in moves:
+            self.report.moved += 1
+            self.report.removed += 1
+            self.report.words_removed += jump.length
+
+    def invert(self):
+        for r in self.order():
+            outs = self.regions[r]
+            if len(outs) < 2:
+                continue
+            cond, jump = outs[-2], outs[-1]
+            if not is_cond_branch(cond) or not is_jump(jump):
+                continue
+            # the conditional has to be skipping over the b and nothing else
+            if self.sym_addr(cond.fixup_sym) != jump.addr + jump.length: # type: ignore
+                continue
+            if not self.short_in_range(cond, jump.fixup_sym): # type: ignore
+                continue
+
+            cond.op ^= (1 << 10)
+            cond.fixup_sym = jump.fixup_sym
+            cond.string = "%s %s" % (CONDITION_NAMES[(cond.op >> 10) & 0xf], jump.fixup_sym.name) # type: ignore
+            self.remove(r, jump)
+            self.report.inverted += 1
+
+    # drop b's to the next address, which can cascade
+    def remove_jumps_to_next(self):
+        changed = True
+        while changed:
+            changed = False
+            self.relayout()
+            for r in self.order():
+                outs = self.regions[r]
+                if outs and is_jump(outs[-1]) and self.sym_addr(outs[-1].fixup_sym) == outs[-1].addr + outs[-1].length: # type: ignore
+                    self.remove(r, outs[-1])
+                    self.report.removed += 1
+                    changed = True
+
+    def run(self) -> BranchReport:
+        self.thread_long()
+
+        fixed = any(branch_target(out) is not None for outs in self.regions for out in outs)
+        if not fixed:
+            self.layout_blocks()
+            self.relayout()
+            self.invert()
+            self.remove_jumps_to_next()
+
+        self.relayout()
+        self.thread_short()
+
+        # write the new layout back
+        output = []
+        for r in self.order():
+            output.extend(self.regions[r])
+        for sym in self.code.symbols.values():
+            if sym.resolved:
+                sym.addr = self.region_addr[self.region_of(sym)]
+        self.code.output = output
+        self.code.cur_addr = self.end
+
+        return self.report
+
+def optimize(code : Codegen) -> BranchReport:
+    return BranchOptimizer(code).run()
+
+# vim: ts=4 sw=4 expandtab:
@@ -1,8 +1,14 @@
 from enum import Enum, Flag, auto
 from typing import Tuple, Any
 import array
+import bisect
+import compress
+import flatimage
+import functools
 import io
 import struct
+import sys
+import symmap
 
 
 # general class of instruction
@@ -107,6 +113,8 @@ class OutputData:
         self.string = ""
         self.fixup_type = FIXUP_TYPE.NONE
         self.fixup_sym : Symbol | None = None
+        self.file = ""
+        self.line = 0
 
     def write_hex(self, outfile : io.IOBase):
         raise NotImplementedError("write_hex not implemented in OutputData")
@@ -207,12 +215,276 @@ def parse_ins_to_string(ins : str, args) -> str:
             parse_tuple_to_string(args[2]))
     return "unk"
 
+# is this an instruction that never falls through to the next one
+def is_unconditional_branch(out : OutputData) -> bool:
+    if not isinstance(out, Instruction) or (out.op >> 14) != 0b10:
+        return False
+    cc = (out.op >> 10) & 0xf
+    # b, or a long/register b without the link bit. b pc just carries on to the next instruction
+    return cc == 0b1110 or (cc == 0b1111 and not out.op & (1 << 9) and out.op & 0xf != 0b1010)
+
+# absolute target of a pc relative branch with an immediate offset, None otherwise
+def branch_target(out : OutputData) -> int | None:
+    if not isinstance(out, Instruction) or (out.op >> 14) != 0b10 or out.fixup_type != FIXUP_TYPE.NONE:
+        return None
+    cc = (out.op >> 10) & 0xf
+    if cc != 0b1111:
+        offset = out.op & 0x3ff
+        if offset & 0x200:
+            offset -= 0x400
+        return out.addr + 1 + offset
+    if out.op & 0xf == 0 and out.length == 2:
+        offset = out.op2 - 0x10000 if out.op2 & 0x8000 else out.op2
+        return out.addr + 2 + offset
+    return None
+
+# encoders
+#
+# opcode_table is compiled into one encoder function per mnemonic and operand
+# shape, e.g. ('add', ('REGISTER', 'NUMBER')). the shape decides which argument
+# lands in which slot, so all of that is worked out once up front and the
+# encoder only has to deal with the argument values.
+#
+# an encoder takes the args and returns (op, op2, length, fixup type, fixup label)
+
+Encoding = Tuple[int, int, int, FIXUP_TYPE, Any]
+
+# operand shapes the parser can produce
+ARG_SHAPES = [
+    (),
+    ('REGISTER',), ('NUMBER',), ('ID',),
+    ('REGISTER', 'REGISTER'), ('REGISTER', 'NUMBER'), ('REGISTER', 'ID'),
+    ('REGISTER', 'REGISTER', 'REGISTER'), ('REGISTER', 'REGISTER', 'NUMBER'), ('REGISTER', 'REGISTER', 'ID'),
+]
+
+def _raise(msg : str):
+    raise Codegen_Exception(msg)
+
+def _raiser(msg : str):
+    def encode(args) -> Encoding:
+        raise Codegen_Exception(msg)
+    return encode
+
+# figure out which arg feeds the dest, a and b slots of an alu instruction.
+# each slot is either an arg index or a fixed default argument
+def _alu_slots(op : IFormat, shape : tuple[str, ...]):
+    R0 = ('REGISTER', 0)
+    arg_count = len(shape)
+
+    if op.atype == ATYPE.NONE:
+        #ATYPE_NONE - nop
+        if arg_count == 0:
+            return (R0, R0, ('NUMBER', 0))
+    elif op.atype == ATYPE.DAB:
+        if arg_count == 3:      # add D, A, B
+            return (0, 1, 2)
+        elif arg_count == 2:    # add D, D, B
+            return (0, 0, 1)
+        elif arg_count == 1:    # add D, D, D
+            return (0, 0, 0)
+    elif op.atype == ATYPE.DAB_LS:
+        if arg_count == 3:      # ldr D, A, B
+            return (0, 1, 2)
+        elif arg_count == 2:    # ldr D, B, r0 or ldr D, r0, IMM
+            # if its two arg, assign immediate to B slot, register to A slot
+            if shape[1] == 'REGISTER':
+                return (0, 1, ('NUMBER', 0))
+            return (0, R0, 1)
+        elif arg_count == 1:    # ldr D, D, r0
+            return (0, 0, ('NUMBER', 0))
+    elif op.atype == ATYPE.DB:
+        #ATYPE_DB - add D, B    --- add D, r0, B
+        if arg_count == 2:
+            temp = 1
+        elif arg_count == 1:
+            temp = 0
+        else:
+            return "add_instruction: invalid number of args for ATYPE_DB"
+
+        # if its regster to register, use the a slot, and assign immediate to b
+        # note IFORMAT_FLAG_FORCE_B is used to force the b_arg into the b slot
+        if shape[temp] == 'REGISTER' and not IFORMAT_FLAG.FORCE_B in op.flags:
+            return (0, temp, ('NUMBER', 0))
+        return (0, R0, temp)
+    elif op.atype == ATYPE.D:
+        #ATYPE_D - b   D
+        if arg_count == 1:
+            return (0, R0, ('NUMBER', 0))
+    elif op.atype == ATYPE.DA_MINUS1:
+        #ATYPE_DA_MINUS1 - not D, A    --- xor D, A, #-1
+        if arg_count == 2:
+            return (0, 1, ('NUMBER', -1))
+        elif arg_count == 1:
+            return (0, 0, ('NUMBER', -1))
+    elif op.atype == ATYPE.AB:
+        #ATYPE_AB - tst A, B    --- xor r0, A, B
+        if arg_count == 2:
+            return (R0, 0, 1)
+        elif arg_count == 1:
+            return (R0, 0, 0)
+
+    return "add_instruction: failed to match atype"
+
+def _compile_alu(op : IFormat, shape : tuple[str, ...]):
+    slots = _alu_slots(op, shape)
+    if isinstance(slots, str):
+        return _raiser(slots)
+
+    d_slot, a_slot, b_slot = slots
+    d_kind = shape[d_slot] if isinstance(d_slot, int) else d_slot[0]
+    a_kind = shape[a_slot] if isinstance(a_slot, int) else a_slot[0]
+    b_kind = shape[b_slot] if isinstance(b_slot, int) else b_slot[0]
+
+    # destination has to be a register, a arg can only be register
+    if d_kind != 'REGISTER':
+        return lambda args: _raise("add_instruction: dest is bogus type '%s'" % str(args[d_slot] if isinstance(d_slot, int) else d_slot))
+    if a_kind != 'REGISTER':
+        return lambda args: _raise("add_instruction: a is bogus type '%s'" % str(args[a_slot] if isinstance(a_slot, int) else a_slot))
+
+    base = op.opcode
+    d_fixed = None if isinstance(d_slot, int) else d_slot[1]
+    a_fixed = None if isinstance(a_slot, int) else a_slot[1]
+    b_fixed = None if isinstance(b_slot, int) else b_slot[1]
+
+    def encode(args) -> Encoding:
+        d = d_fixed if d_fixed is not None else args[d_slot][1]
+        a = a_fixed if a_fixed is not None else args[a_slot][1]
+        b = b_fixed if b_fixed is not None else args[b_slot][1]
+
+        # if it's a special register, chop the top bit off and we'll deal with it in the b field
+        op = base | (d & 0x7) << 8 | (a & 0x7) << 5
+        d_special = d >= 8
+        a_special = a >= 8
+
+        # b arg can be any type, unless a or d is a special reg,
+        # then b can only be an immediate
+        if b_kind == 'REGISTER':
+            if d_special or a_special:
+                raise Codegen_Exception("add_instruction: b cannot be register with special d or a");
+            return (op | (0b10 << 3) | b, 0, 1, FIXUP_TYPE.NONE, None)
+        elif b_kind == 'NUMBER':
+            num = int(b)
+
+            # if no special regs, and the immediate fits in 4 bits
+            if not d_special and not a_special and num < 8 and num >= -7:
+                # we can use 4 bit immediate
+                return (op | (0 << 4) | (num & 0xf), 0, 1, FIXUP_TYPE.NONE, None)
+
+            # if either d or a is special, we'll need to reuse the b field to encode it
+            op |= (0b11 << 3)
+            if a_special: op |= (1 << 0)
+            if d_special: op |= (1 << 1)
+            if num != 0:
+                # going to have to use a full 16 bit immediate
+                return (op | (1 << 2), num & 0xffff, 2, FIXUP_TYPE.NONE, None)
+            return (op, 0, 1, FIXUP_TYPE.NONE, None)
+        elif b_kind == 'ID':
+            # store the eventual absolute address, patched later
+            op |= (0b11 << 3) | (1 << 2)
+            if a_special: op |= (1 << 0)
+            if d_special: op |= (1 << 1)
+            return (op, 0, 2, FIXUP_TYPE.SYMBOL_LONG, b)
+        raise Codegen_Exception("add_instruction: b is bogus type '%s'" % str(args[b_slot]))
+
+    return encode
+
+def _compile_branch(op : IFormat, shape : tuple[str, ...]):
+    if len(shape) != 1:
+        return _raiser("add_instruction: invalid number of args for branch")
+    kind = shape[0]
+    base = op.opcode
+    lop = base | (0xf << 10) # long branches use NV condition
+
+    def short_number(args) -> Encoding:
+        val = args[0][1]
+        if val >= 512 or val < -512:
+            raise Codegen_Exception("add_instruction: short branch with too large offset %d" % int(val))
+        # it's a short immediate, just encode the instruction
+        return (base | (int(val) & 0x3ff), 0, 1, FIXUP_TYPE.NONE, None)
+
+    def short_label(args) -> Encoding:
+        # short branch, target is unresolved
+        return (base, 0, 1, FIXUP_TYPE.SHORT_BRANCH, args[0][1])
+
+    def long_register(args) -> Encoding:
+        # its a register branch
+        val = args[0][1]
+        if (val == 0):
+            raise Codegen_Exception("add_instruction: cannot generate register branch with r0")
+        return (lop | val, 0, 1, FIXUP_TYPE.NONE, None)
+
+    def long_number(args) -> Encoding:
+        # it's a 16bit signed immediate 2-word branch
+        return (lop, args[0][1] & 0xffff, 2, FIXUP_TYPE.NONE, None)
+
+    def long_label(args) -> Encoding:
+        # 16 bit long address, target is unresolved
+        return (lop, 0, 2, FIXUP_TYPE.LONG_BRANCH, args[0][1])
+
+    def short_or_long_number(args) -> Encoding:
+        # the only form that depends on the value, short if the offset fits
+        val = args[0][1]
+        if val >= 512 or val < -512:
+            return (lop, val & 0xffff, 2, FIXUP_TYPE.NONE, None)
+        return (base | (int(val) & 0x3ff), 0, 1, FIXUP_TYPE.NONE, None)
+
+    # see what form it is. registers need the long form, and label branches
+    # are all long form for now (XXX hack)
+    if op.itype == ITYPE.LONG_BRANCH or (op.itype == ITYPE.SHORT_OR_LONG_BRANCH and kind in ('REGISTER', 'ID')):
+        forms = { 'REGISTER': long_register, 'NUMBER': long_number, 'ID': long_label }
+        return forms.get(kind, lambda args: (lop, 0, 1, FIXUP_TYPE.NONE, None))
+    if op.itype == ITYPE.SHORT_OR_LONG_BRANCH and kind == 'NUMBER':
+        return short_or_long_number
+    forms = { 'REGISTER': _raiser("add_instruction: register on short branch"), 'NUMBER': short_number, 'ID': short_label }
+    return forms.get(kind, lambda args: (base, 0, 1, FIXUP_TYPE.NONE, None))
+
+def compile_encoder(ins : str, shape : tuple[str, ...]):
+    op = opcode_table[ins]
+    if op.itype == ITYPE.ALU:
+        return _compile_alu(op, shape)
+    elif op.itype in (ITYPE.SHORT_BRANCH, ITYPE.LONG_BRANCH, ITYPE.SHORT_OR_LONG_BRANCH):
+        return _compile_branch(op, shape)
+    return _raiser("add_instruction: unhandled ITYPE")
+
+encoders = { (ins, shape): compile_encoder(ins, shape) for ins in opcode_table for shape in ARG_SHAPES }
+
+def get_encoder(ins : str, args):
+    shape = tuple(a[0] for a in args)
+    try:
+        return encoders[(ins, shape)]
+    except KeyError:
+        if ins not in opcode_table:
+            raise Codegen_Exception("add_instruction: unknown instruction '%s'" % ins[0])
+        enc = encoders[(ins, shape)] = compile_encoder(ins, shape)
+        return enc
+
+# generated code repeats the same instruction forms over and over, so remember
+# how each one encodes. labels are carried by name, so the encoding doesn't
+# depend on any symbol state and instructions with fixups can be cached too
+ENCODE_CACHE_SIZE = 4096
+
+@functools.lru_cache(maxsize=ENCODE_CACHE_SIZE)
+def encode_instruction(ins : str, args) -> tuple[int, int, int, FIXUP_TYPE, Any, str]:
+    op, op2, length, fixup_type, label = get_encoder(ins, args)(args)
+    return (op, op2, length, fixup_type, label, parse_ins_to_string(ins, args))
+
 class Codegen:
     def __init__(self) -> None:
         self.cur_addr : int = 0
         self.output : list[OutputData] = []
         self.symbols : dict[str, Symbol]  = {}
         self.verbose : bool = False
+
+        # source location of the statement being assembled, set by the parser
+        self.cur_file : str = ""
+        self.cur_line : int = 0
+
+        # every source file the preprocessor pulled in
+        self.files : list[str] = []
+
+        # labels defined more than once. the later definition replaces the
+        # symbol, so references before and after it end up in different places
+        self.redefined : list[str] = []
         pass
 
     def add_label(self, label : str):
@@ -222,6 +494,7 @@ class Codegen:
         try:
             sym = self.symbols[label]
             if sym.resolved:
+                self.redefined.append(label)
                 raise Codegen_Exception("add_label: already seem symbol %s" % label)
 
             # it's now resolved
@@ -245,12 +518,17 @@ class Codegen:
             self.symbols[label] = sym
             return sym
 
+    def set_location(self, out : OutputData):
+        out.file = self.cur_file
+        out.line = self.cur_line
+
     def add_directive(self, ins : str, args : tuple[str, ...]):
         if self.verbose: print("add directive %s" % str(ins))
         if ins == ".word":
             d = Data()
             d.addr = self.cur_addr
             d.length = 1
+            self.set_location(d)
             if args[0][0] == 'NUMBER':
                 num = int(args[0][1])
                 d.string = ".word %04x" % num
@@ -269,6 +547,7 @@ class Codegen:
             d = Data()
             d.string = "%s '%s'" % (ins, args[0])
             d.addr = self.cur_addr
+            self.set_location(d)
 
             for c in args[0]:
                 d.data.append(ord(c))
@@ -292,6 +571,7 @@ class Codegen:
 
             d = Data()
             d.addr = self.cur_addr
+            self.set_location(d)
             d.data.frombytes(s.encode('utf-8'))
             d.string = "%s '%s'" % (ins, args[0])
             d.length = len(d.data)
@@ -306,239 +586,162 @@ class Codegen:
 
         i = Instruction()
         i.addr = self.cur_addr
+        self.set_location(i)
 
-        # lookup the opcode
-        try:
-            op = opcode_table[ins]
-        except:
-            raise Codegen_Exception("add_instruction: unknown instruction '%s'" % ins[0])
-
-        i.op = op.opcode
-        i.length = 1
-
-        arg_count = len(args)
-
-        # switch based on type
-        if (op.itype == ITYPE.ALU):
-            # set the default args
-            dest_arg : Tuple[str, int] = ('REGISTER', 0)  # default to r0
-            a_arg : Tuple[str, int] = ('REGISTER', 0)  # default to r0
-            b_arg : Tuple[str, int] = ('NUMBER', 0)  # default to 0
-
-            # match args based on instruction atype
-            match = False
-            if op.atype == ATYPE.NONE:
-                #ATYPE_NONE - nop
-                if arg_count == 0:
-                    match = True
-            elif op.atype == ATYPE.DAB:
-                if arg_count == 3:      # add D, A, B
-                    dest_arg = args[0]
-                    a_arg = args[1]
-                    b_arg = args[2]
-                    match = True
-                elif arg_count == 2:    # add D, D, B
-                    dest_arg = args[0]
-                    a_arg = args[0]
-                    b_arg = args[1]
-                    match = True
-                elif arg_count == 1:    # add D, D, D
-                    dest_arg = args[0]
-                    a_arg = args[0]
-                    b_arg = args[0]
-                    match = True
-            elif op.atype == ATYPE.DAB_LS:
-                if arg_count == 3:      # ldr D, A, B
-                    dest_arg = args[0]
-                    a_arg = args[1]
-                    b_arg = args[2]
-                    match = True
-                elif arg_count == 2:    # ldr D, B, r0 or ldr D, r0, IMM
-                    dest_arg = args[0]
-                    # if its two arg, assign immediate to B slot, register to A slot
-                    if args[1][0] == 'REGISTER':
-                        a_arg = args[1]
-                    else:
-                        b_arg = args[1]
-                    match = True
-                elif arg_count == 1:    # ldr D, D, r0
-                    dest_arg = args[0]
-                    a_arg = args[0]
-                    match = True
-            elif op.atype == ATYPE.DB:
-                #ATYPE_DB - add D, B    --- add D, r0, B
-                if arg_count == 2:
-                    dest_arg = args[0]
-                    temp_arg = args[1]
-                    match = True
-                elif arg_count == 1:
-                    dest_arg = args[0]
-                    temp_arg = args[0]
-                    match = True
-                else:
-                    raise Codegen_Exception("add_instruction: invalid number of args for ATYPE_DB")
-
-                # if its regster to register, use the a slot, and assign immediate to b
-                # note IFORMAT_FLAG_FORCE_B is used to force the b_arg into the b slot
-                if match and temp_arg[0] == 'REGISTER' and not IFORMAT_FLAG.FORCE_B in op.flags:
-                    a_arg = temp_arg
-                else:
-                    b_arg = temp_arg
-            elif op.atype == ATYPE.D:
-                #ATYPE_D - b   D
-                if arg_count == 1:
-                    dest_arg = args[0]
-                    match = True
-            elif op.atype == ATYPE.DA_MINUS1:
-                #ATYPE_DA_MINUS1 - not D, A    --- xor D, A, #-1
-                if arg_count == 2:
-                    dest_arg = args[0]
-                    a_arg = args[1]
-                    b_arg = ('NUMBER', -1)
-                    match = True
-                elif arg_count == 1:
-                    dest_arg = args[0]
-                    a_arg = args[0]
-                    b_arg = ('NUMBER', -1)
-                    match = True
-            elif op.atype == ATYPE.AB:
-                #ATYPE_AB - tst A, B    --- xor r0, A, B
-                if arg_count == 2:
-                    a_arg = args[0]
-                    b_arg = args[1]
-                    match = True
-                elif arg_count == 1:
-                    a_arg = args[0]
-                    b_arg = args[0]
-                    match = True
-
-            if not match:
-                raise Codegen_Exception("add_instruction: failed to match atype")
-
-            d_special = False
-            a_special = False
-
-            if self.verbose: print("add_instruction post processing dest %s, a %s, b %s" % (str(dest_arg), str(a_arg), str(b_arg)))
-
-            # construct the instruction out of the ops
-            # destination has to be a register
-            # if it's a special register, chop the top bit off and we'll deal with it in the b field
-            if dest_arg[0] == 'REGISTER':
-                i.op |= (dest_arg[1] & 0x7) << 8
-                if dest_arg[1] >= 8: d_special = True
-            else:
-                raise Codegen_Exception("add_instruction: dest is bogus type '%s'" % str(dest_arg))
-
-            # a arg can only be register
-            # if it's a special register, chop the top bit off and we'll deal with it in the b field
-            if a_arg[0] == 'REGISTER':
-                i.op |= (a_arg[1] & 0x7) << 5
-                if a_arg[1] >= 8: a_special = True
-            else:
-                raise Codegen_Exception("add_instruction: a is bogus type '%s'" % str(a_arg))
-
-            # b arg can be any type, unless a or d is a special reg,
-            # then b can only be an immediate
-            if b_arg[0] == 'REGISTER':
-                if d_special or a_special:
-                    raise Codegen_Exception("add_instruction: b cannot be register with special d or a");
-                i.op |= (0b10 << 3) | b_arg[1]
-            elif b_arg[0] == 'NUMBER':
-                num = int(b_arg[1])
-
-                # if no special regs, and the immediate fits in 4 bits
-                if not d_special and not a_special and num < 8 and num >= -7:
-                    # we can use 4 bit immediate
-                    i.op |= (0 << 4) | (num & 0xf)
-                else:
-                    # if either d or a is special, we'll need to reuse the b field to encode it
-                    i.op |= (0b11 << 3)
-                    if a_special: i.op |= (1 << 0)
-                    if d_special: i.op |= (1 << 1)
-                    if num != 0:
-                        # going to have to use a full 16 bit immediate
-                        i.op |= (1 << 2)
-                        i.op2 = num & 0xffff
-                        i.length = 2
-            elif b_arg[0] == 'ID':
-                # store the eventual absolute address
-                i.fixup_type = FIXUP_TYPE.SYMBOL_LONG
-                i.fixup_sym = self.get_symbol_ref(b_arg[1]) # type: ignore
-
-                # if either d or a is special, we'll need to reuse the b field to encode it
-                i.op |= (0b11 << 3)
-                if a_special: i.op |= (1 << 0)
-                if d_special: i.op |= (1 << 1)
-
-                # going to have to use a full 16 bit immediate
-                i.op |= (1 << 2)
-                i.op2 = 0 # patched later
-                i.length = 2
-            else:
-                raise Codegen_Exception("add_instruction: b is bogus type '%s'" % str(b_arg))
-        elif op.itype == ITYPE.SHORT_BRANCH or op.itype == ITYPE.LONG_BRANCH or op.itype == ITYPE.SHORT_OR_LONG_BRANCH:
-            # handle branches
-            if arg_count != 1:
-                raise Codegen_Exception("add_instruction: invalid number of args for branch")
-
-            arg = args[0]
-
-            # see what form it is
-            long_branch = False
-            if op.itype == ITYPE.LONG_BRANCH:
-                long_branch = True
-            elif op.itype == ITYPE.SHORT_OR_LONG_BRANCH:
-                # further tests
-                if arg[0] == 'REGISTER':
-                    long_branch = True
-                elif arg[0] == 'NUMBER' and (arg[1] >= 512 or arg[1] < -512):
-                    long_branch = True
-                elif arg[0] == 'ID':
-                    # XXX hack, for now make all label branches long form
-                    long_branch = True
-
-            # deal with branch types
-            if not long_branch:
-                # short branch
-                if arg[0] == 'REGISTER':
-                    raise Codegen_Exception("add_instruction: register on short branch")
-                elif arg[0] == 'NUMBER':
-                    if arg[1] >= 512 or arg[1] < -512:
-                        raise Codegen_Exception("add_instruction: short branch with too large offset %d" % int(arg[1]))
-                    # it's a short immediate, just encode the instruction
-                    i.op |= (int(arg[1]) & 0x3ff)
-                elif arg[0] == 'ID':
-                    # short branch, target is unresolved
-                    i.fixup_type = FIXUP_TYPE.SHORT_BRANCH
-                    i.fixup_sym = self.get_symbol_ref(arg[1]) # type: ignore
-            else:
-                # long branch
-                i.op |= (0xf << 10); # use NV condition
-
-                if arg[0] == 'REGISTER':
-                    # its a register branch
-                    if (arg[1] == 0):
-                        raise Codegen_Exception("add_instruction: cannot generate register branch with r0")
-                    i.op |= arg[1]
-                elif arg[0] == 'NUMBER':
-                    # it's a 16bit signed immediate 2-word branch
-                    i.op2 = (arg[1] & 0xffff)
-                    i.length += 1
-                elif arg[0] == 'ID':
-                    # 16 bit long address, target is unresolved
-                    i.op2 = 0
-                    i.length += 1
-                    i.fixup_type = FIXUP_TYPE.LONG_BRANCH
-                    i.fixup_sym = self.get_symbol_ref(arg[1]) # type: ignore
-                    pass
-        else:
-            raise Codegen_Exception("add_instruction: unhandled ITYPE")
-
-        i.string = parse_ins_to_string(ins, args)
+        i.op, i.op2, i.length, i.fixup_type, label, i.string = encode_instruction(ins, args)
+        if label is not None:
+            i.fixup_sym = self.get_symbol_ref(label)
 
         self.output.append(i)
         self.cur_addr += i.length
 
+    # append a fragment assembled separately, starting at address 0, relocating its
+    # output and labels to the current address and merging its symbols into ours.
+    # has to run before handle_fixups
+    def link(self, frag : 'Codegen'):
+        if frag.redefined:
+            raise Codegen_Exception("link: fragment redefines label '%s'" % frag.redefined[0])
+
+        base = self.cur_addr
+        for name, fsym in frag.symbols.items():
+            sym = self.get_symbol_ref(name)
+            if fsym.resolved:
+                if sym.resolved:
+                    raise Codegen_Exception("link: label '%s' defined in more than one fragment" % name)
+                sym.addr = fsym.addr + base
+                sym.resolved = True
+
+        for out in frag.output:
+            out.addr += base
+            if out.fixup_sym is not None:
+                out.fixup_sym = self.symbols[out.fixup_sym.name]
+        self.output.extend(frag.output)
+        self.cur_addr += frag.cur_addr
+
+        for f in frag.files:
+            if f not in self.files:
+                self.files.append(f)
+
+    # carve the output up at every label, labels sharing an address share a region.
+    # returns the sorted region start addresses and the output in each region
+    def split_regions(self) -> tuple[list[int], list[list[OutputData]]]:
+        bounds = sorted({ s.addr for s in self.symbols.values() if s.resolved } | { 0 })
+        regions : list[list[OutputData]] = [ [] for _ in bounds ]
+        r = 0
+        for out in self.output:
+            while r + 1 < len(bounds) and out.addr >= bounds[r + 1]:
+                r += 1
+            regions[r].append(out)
+        return (bounds, regions)
+
+    # garbage collect label delimited regions that can't be reached from the entry symbol.
+    # has to run before handle_fixups, returns a list of (name, addr, length) for the removed regions
+    def gc(self, entry : str = 'start') -> list[tuple[str, int, int]]:
+        try:
+            sym = self.symbols[entry]
+        except KeyError:
+            raise Codegen_Exception("gc: entry symbol '%s' not found" % entry)
+        if not sym.resolved:
+            raise Codegen_Exception("gc: entry symbol '%s' is unresolved" % entry)
+
+        # anything before the first label is always kept
+        labels = { s.addr for s in self.symbols.values() if s.resolved }
+        bounds, regions = self.split_regions()
+        region_index = { addr: i for i, addr in enumerate(bounds) }
+
+        def region_of(sym : Symbol) -> int | None:
+            if not sym.resolved:
+                return None
+            return region_index[sym.addr]
+
+        # walk the references, starting at the entry point
+        live = [ False ] * len(bounds)
+        work = [ region_index[sym.addr] ]
+        if 0 not in labels:
+            work.append(0)
+        while work:
+            r = work.pop()
+            if live[r]:
+                continue
+            live[r] = True
+
+            for out in regions[r]:
+                if out.fixup_sym is not None:
+                    target = region_of(out.fixup_sym)
+                    if target is not None:
+                        work.append(target)
+                # so is wherever a pc relative branch with an immediate offset lands
+                addr = branch_target(out)
+                if addr is not None and addr >= 0:
+                    work.append(bisect.bisect_right(bounds, addr) - 1)
+
+            # execution falls into the next region unless we end on an unconditional branch
+            if r + 1 < len(bounds):
+                if not regions[r] or not is_unconditional_branch(regions[r][-1]):
+                    work.append(r + 1)
+
+        if all(live):
+            return []
+
+        # pc relative branches with immediate offsets can't be moved around
+        for r, outs in enumerate(regions):
+            if not live[r]:
+                continue
+            for out in outs:
+                target = branch_target(out)
+                if target is None:
+                    continue
+                lo, hi = min(out.addr, target), max(out.addr, target)
+                for dead in range(len(bounds)):
+                    if not live[dead] and lo < bounds[dead] < hi:
+                        raise Codegen_Exception("gc: branch at 0x%04x jumps over unreferenced code at 0x%04x" % (out.addr, bounds[dead]))
+
+        # build the report and drop the dead symbols
+        names : dict[int, list[str]] = {}
+        for s in list(self.symbols.values()):
+            if s.resolved and not live[region_index[s.addr]]:
+                names.setdefault(s.addr, []).append(s.name)
+                del self.symbols[s.name]
+
+        removed = []
+        for r, outs in enumerate(regions):
+            if not live[r]:
+                length = sum(out.length for out in outs)
+                removed.append(("/".join(names[bounds[r]]), bounds[r], length))
+                if self.verbose: print("gc: removing %s at 0x%04x, %d words" % (removed[-1][0], bounds[r], length))
+
+        # lay out what's left
+        addr_map : dict[int, int] = {}
+        output : list[OutputData] = []
+        addr = 0
+        for r, outs in enumerate(regions):
+            if not live[r]:
+                continue
+            addr_map[bounds[r]] = addr
+            for out in outs:
+                out.addr = addr
+                addr += out.length
+                output.append(out)
+        for s in self.symbols.values():
+            if s.resolved:
+                s.addr = addr_map[s.addr] if s.addr in addr_map else addr
+        self.output = output
+        self.cur_addr = addr
+
+        return removed
+
+    # thread branches and lay out blocks so jumps fall through, see branchopt.py.
+    # has to run before handle_fixups
+    def optimize_branches(self):
+        import branchopt
+        return branchopt.optimize(self)
+
+    # load wide immediates used inside loops into free registers up front, see
+    # loopopt.py. has to run before handle_fixups
+    def hoist_loop_constants(self):
+        import loopopt
+        return loopopt.optimize(self)
+
     def handle_fixups(self) -> None:
         for ins in self.output:
             if ins.fixup_type == FIXUP_TYPE.NONE:
@@ -621,4 +824,40 @@ class Codegen:
         for out in self.output:
             out.write_bin(binfile)
 
+    def output_compressed(self, binfile):
+        binfile.write(compress.compress(self.image()))
+
+    def output_map(self, mapfile):
+        symmap.write_map(self, mapfile)
+
+    def output_flat(self, flatfile, entry : str = 'start'):
+        sym = self.symbols.get(entry)
+        addr = sym.addr if sym is not None and sym.resolved else 0
+        buf = io.BytesIO()
+        symmap.write_map(self, buf)
+        flatimage.write_flat(flatfile, self.image(), self.segments(), addr, buf.getvalue())
+
+    # runs of code and data, as (start, length, flags) with the flatimage.SEG_ flags
+    def segments(self) -> list[tuple[int, int, int]]:
+        segs : list[tuple[int, int, int]] = []
+        for out in self.output:
+            if out.length == 0:
+                continue
+            flags = flatimage.SEG_CODE if isinstance(out, Instruction) else flatimage.SEG_DATA
+            if segs and segs[-1][2] == flags and segs[-1][0] + segs[-1][1] == out.addr:
+                start, length, _ = segs[-1]
+                segs[-1] = (start, length + out.length, flags)
+            else:
+                segs.append((out.addr, out.length, flags))
+        return segs
+
+    # return the assembled image as an array of 16 bit words, starting at address 0
+    def image(self) -> array.array:
+        buf = io.BytesIO()
+        self.output_binary(buf)
+        words = array.array('H', buf.getvalue())
+        if sys.byteorder == 'little':
+            words.byteswap()
+        return words
+
 # vim: ts=4 sw=4 expandtab:
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+
+# compressed image format
+#
+# a word oriented lz/rle scheme, simple enough to decode on the microcontroller
+# driving the serial loader. the decoder only needs the image it is writing
+# into (back references point at words it has already produced), a few words
+# of state, and no tables. everything is stored as big endian 16 bit words.
+#
+# header (4 words):
+#   0x5a32          magic, 'Z2'
+#   0x0001          version
+#   length hi       length of the decompressed image in words
+#   length lo
+#
+# token stream, until length words have been produced:
+#   00nnnnnnnnnnnnnn    literal: n words follow and are copied out
+#   01nnnnnnnnnnnnnn    fill: one word follows and is repeated n times
+#   10nnnnnnnnnnnnnn    back reference: a distance word d follows, copy n words
+#                       starting d words behind the current output position.
+#                       the source may overlap the words being produced.
+#   11xxxxxxxxxxxxxx    reserved
+#
+# n is always 1..16383, d is 1..65535.
+
+import argparse
+import array
+import sys
+
+Z_MAGIC = 0x5a32
+Z_VERSION = 1
+
+TOKEN_LITERAL = 0 << 14
+TOKEN_FILL = 1 << 14
+TOKEN_BACKREF = 2 << 14
+TOKEN_MASK = 3 << 14
+MAX_RUN = 0x3fff
+MAX_DISTANCE = 0xffff
+
+# fills and back references cost two words, so they only win at 3 or more
+MIN_MATCH = 3
+
+# how many earlier positions to try per hash bucket
+MAX_CHAIN = 32
+
+class CompressError(Exception):
+    pass
+
+def _to_bytes(words) -> bytes:
+    out = array.array('H', words)
+    if sys.byteorder == 'little':
+        out.byteswap()
+    return out.tobytes()
+
+def compress(image : array.array) -> bytes:
+    n = len(image)
+    out = array.array('H', [ Z_MAGIC, Z_VERSION, n >> 16, n & 0xffff ])
+
+    # most recent positions of each 3 word sequence
+    chains : dict[tuple[int, int, int], list[int]] = {}
+
+    literal_start = 0
+    pos = 0
+
+    def flush_literals(end : int):
+        start = literal_start
+        while start < end:
+            run = min(end - start, MAX_RUN)
+            out.append(TOKEN_LITERAL | run)
+            out.extend(image[start:start + run])
+            start += run
+
+    def remember(p : int):
+        if p + MIN_MATCH <= n:
+            key = (image[p], image[p + 1], image[p + 2])
+            chain = chains.setdefault(key, [])
+            chain.append(p)
+            if len(chain) > MAX_CHAIN:
+                del chain[0]
+
+    while pos < n:
+        limit = min(n - pos, MAX_RUN)
+
+        # length of the fill starting here
+        fill = 1
+        while fill < limit and image[pos + fill] == image[pos]:
+            fill += 1
+
+        # longest back reference from the hash chain
+        best_len = 0
+        best_dist = 0
+        if pos + MIN_MATCH <= n:
+            for cand in reversed(chains.get((image[pos], image[pos + 1], image[pos + 2]), ())):
+                dist = pos - cand
+                if dist > MAX_DISTANCE:
+                    break
+                length = MIN_MATCH
+                while length < limit and image[cand + length] == image[pos + length]:
+                    length += 1
+                if length > best_len:
+                    best_len = length
+                    best_dist = dist
+                    if length == limit:
+                        break
+
+        if fill >= MIN_MATCH and fill >= best_len:
+            flush_literals(pos)
+            out.append(TOKEN_FILL | fill)
+            out.append(image[pos])
+            step = fill
+        elif best_len >= MIN_MATCH:
+            flush_literals(pos)
+            out.append(TOKEN_BACKREF | best_len)
+            out.append(best_dist)
+            step = best_len
+        else:
+            remember(pos)
+            pos += 1
+            continue
+
+        for p in range(pos, pos + step):
+            remember(p)
+        pos += step
+        literal_start = pos
+
+    flush_literals(n)
+    return _to_bytes(out)
+
+# streaming decoder
+#
+# feed it the compressed stream in chunks of any size, it returns the words
+# that became available with each chunk. the decoded image is kept in
+# self.image, which is also the back reference window.
+class Decoder:
+    def __init__(self) -> None:
+        self.image = array.array('H')
+        self.length = -1
+        self.pending = b''
+        self.words = array.array('H')
+        self.wpos = 0
+
+    def done(self) -> bool:
+        return self.length >= 0 and len(self.image) == self.length
+
+    def feed(self, data : bytes) -> array.array:
+        data = self.pending + data
+        usable = len(data) & ~1
+        self.pending = data[usable:]
+
+        # keep only the unconsumed words around
+        words = array.array('H', data[:usable])
+        if sys.byteorder == 'little':
+            words.byteswap()
+        self.words = self.words[self.wpos:]
+        self.words.extend(words)
+        self.wpos = 0
+
+        start = len(self.image)
+        self._run()
+        return self.image[start:]
+
+    def _run(self):
+        words = self.words
+        image = self.image
+        avail = len(words)
+        pos = self.wpos
+
+        if self.length < 0:
+            if avail < 4:
+                return
+            if words[0] != Z_MAGIC:
+                raise CompressError("bad compressed image magic")
+            if words[1] != Z_VERSION:
+                raise CompressError("unsupported compressed image version %d" % words[1])
+            self.length = (words[2] << 16) | words[3]
+            pos = 4
+
+        length = self.length
+        while len(image) < length and pos < avail:
+            token = words[pos]
+            kind = token & TOKEN_MASK
+            run = token & MAX_RUN
+            if run == 0 or len(image) + run > length:
+                raise CompressError("bad token 0x%04x at output word %d" % (token, len(image)))
+
+            if kind == TOKEN_LITERAL:
+                if pos + 1 + run > avail:
+                    break
+                image.extend(words[pos + 1:pos + 1 + run])
+                pos += 1 + run
+            elif kind == TOKEN_FILL:
+                if pos + 2 > avail:
+                    break
+                image.extend(array.array('H', [ words[pos + 1] ]) * run)
+                pos += 2
+            elif kind == TOKEN_BACKREF:
+                if pos + 2 > avail:
+                    break
+                dist = words[pos + 1]
+                src = len(image) - dist
+                if dist == 0 or src < 0:
+                    raise CompressError("bad back reference distance %d at output word %d" % (dist, len(image)))
+                if dist >= run:
+                    image.extend(image[src:src + run])
+                else:
+                    # overlapping copy, repeat the pattern
+                    pattern = image[src:]
+                    image.extend((pattern * (run // dist + 1))[:run])
+                pos += 2
+            else:
+                raise CompressError("reserved token 0x%04x" % token)
+
+        self.wpos = pos
+
+def decompress(data : bytes) -> array.array:
+    d = Decoder()
+    d.feed(data)
+    if not d.done():
+        raise CompressError("truncated compressed image")
+    return d.image
+
+def main():
+    parser = argparse.ArgumentParser(description="decompress an image generated by asm.py -z")
+    parser.add_argument('infile', type=argparse.FileType('rb'), help="compressed image")
+    parser.add_argument('-o','--out', nargs=1, type=argparse.FileType('wb'), required=True, help="output binary")
+
+    args = parser.parse_args()
+
+    image = decompress(args.infile.read())
+    args.out[0].write(_to_bytes(image))
+    args.out[0].close()
+
+if __name__ == "__main__":
+    main()
+
+# vim: ts=4 sw=4 expandtab:
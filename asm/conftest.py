@@ -0,0 +1,74 @@
+# shared pytest setup for the assembler tests
+#
+# fixtures/<pass>/<name>.asm are small sources for one of the assembler's
+# passes. test_fixtures.py assembles each one with the options for its pass
+# and compares the result against <name>.hex, or, for sources the pass has to
+# refuse, the error in <name>.err.
+
+import glob
+import io
+import os
+
+import pytest
+
+import asm
+import codegen
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+
+# the asm.assemble() options each pass's fixtures are built with
+PASS_OPTIONS : dict[str, dict] = {
+    'gc': { 'gc_entry': 'start' },
+    'branchopt': { 'opt_branches': True },
+    'loopopt': { 'hoist_loops': True },
+}
+
+# assemble a source file, or a string of source if text is given
+def assemble_source(path : str, text : str | None = None, **options) -> codegen.Codegen:
+    if text is not None:
+        f = io.StringIO(text)
+        f.name = path
+        # skip cpp, the line marker is what it would have started with
+        return asm.assemble(f, lines=io.StringIO('# 1 "%s"\n' % path + text), **options)
+    with open(path) as f:
+        return asm.assemble(f, **options)
+
+# the fixture sources for a pass, all of them or the one called stem
+def pass_sources(name : str, stem : str = '*') -> list[str]:
+    return sorted(glob.glob(os.path.join(FIXTURES, name, stem + '.asm')))
+
+def hex_output(code : codegen.Codegen) -> str:
+    out = io.StringIO()
+    code.output_hex(out)
+    return out.getvalue()
+
+def pytest_generate_tests(metafunc):
+    # a test taking 'pass_fixture' runs once for every fixture source, with the
+    # source's path and the options for its pass
+    if 'pass_fixture' in metafunc.fixturenames:
+        params = []
+        ids = []
+        for name, options in sorted(PASS_OPTIONS.items()):
+            for path in pass_sources(name):
+                params.append((path, options))
+                ids.append("%s/%s" % (name, os.path.basename(path)[:-4]))
+        metafunc.parametrize('pass_fixture', params, ids=ids)
+
+@pytest.fixture
+def assemble():
+    return assemble_source
+
+@pytest.fixture
+def to_hex():
+    return hex_output
+
+@pytest.fixture
+def fixture_sources():
+    return pass_sources
+
+@pytest.fixture
+def src_files() -> list[str]:
+    return sorted(glob.glob(os.path.join(SRC_DIR, '*.asm')))
+
+# vim: ts=4 sw=4 expandtab:
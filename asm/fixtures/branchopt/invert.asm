@@ -0,0 +1,9 @@
+// a conditional branch over a b becomes the opposite condition
+start:
+    cmp r1, 0
+    beq skip
+    b   far
+skip:
+    add r1, 1
+far:
+    b   start
@@ -0,0 +1,12 @@
+// a block only reached by a jump is moved after the jump and falls through
+start:
+    mov r1, 0
+    b   second
+
+third:
+    add r1, 3
+    b   start
+
+second:
+    add r1, 2
+    b   third
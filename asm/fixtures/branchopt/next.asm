@@ -0,0 +1,7 @@
+// a b to the very next address is dropped
+start:
+    mov r1, 1
+    b   next
+next:
+    add r1, 1
+    b   start
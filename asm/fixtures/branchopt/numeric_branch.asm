@@ -0,0 +1,10 @@
+// a pc relative branch with an immediate offset can't follow moved code,
+// so nothing that changes addresses is done
+start:
+    mov r1, 0
+    b   next
+next:
+    add r1, 1
+    bne 1
+    nop
+    b   start
@@ -0,0 +1,17 @@
+// branches to a b go straight to its target
+start:
+    cmp r1, 0
+    beq hop
+    bl  func
+    b   hop
+
+func:
+    add r1, 1
+    b   lr
+
+hop:
+    b   done
+
+done:
+    mov r2, r1
+    b   start
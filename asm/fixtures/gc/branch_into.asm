@@ -0,0 +1,12 @@
+// a pc relative branch that lands on the first word of a region keeps it alive
+start:
+    cmp r1, 0
+    beq 2
+    b   start
+target:
+    mov r2, 1
+    b   start
+
+dead:
+    mov r3, 3
+    b   start
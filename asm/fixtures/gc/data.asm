@@ -0,0 +1,15 @@
+// tables referenced by code or by other data are kept, the rest go
+start:
+    mov r1, table
+    ldr r2, r1
+    b   start
+
+orphan:
+.asciiz "never used"
+
+table:
+.word   message
+.word   0
+
+message:
+.asciiz "hi"
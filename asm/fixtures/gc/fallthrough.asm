@@ -0,0 +1,18 @@
+// a region that doesn't end in an unconditional branch keeps the next one alive
+    mov sp, 0x100
+
+start:
+    mov r1, 0
+loop:
+    add r1, 1
+    cmp r1, 10
+    bne loop
+tail:
+    mov r2, r1
+    b   start
+
+dead:
+    mov r3, 3
+dead2:
+    mov r4, 4
+    b   dead
@@ -0,0 +1,9 @@
+// a pc relative branch over a dead region can't be fixed up
+start:
+    b   4
+dead:
+    nop
+    nop
+    nop
+live:
+    b   start
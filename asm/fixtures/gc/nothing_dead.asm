@@ -0,0 +1,8 @@
+// with everything reachable the image is left as it is
+start:
+    bl  func
+    b   start
+
+func:
+    mov r1, 0x1234
+    b   lr
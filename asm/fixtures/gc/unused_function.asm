@@ -0,0 +1,13 @@
+// a function nothing calls is dropped, the one that is called stays
+start:
+    mov r1, 1
+    bl  used
+    b   start
+
+unused:
+    add r1, r2
+    b   lr
+
+used:
+    add r1, 1
+    b   lr
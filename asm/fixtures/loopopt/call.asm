@@ -0,0 +1,17 @@
+// registers the called function uses aren't free for the loop
+start:
+    mov r1, 0
+loop:
+    bl  scale
+    add r1, 1
+    cmp r1, 500
+    bne loop
+die:
+    b   die
+
+scale:
+    mov r2, r1
+    and r2, 0x0ff0
+    mov r3, 0x4000
+    str r2, r3
+    b   lr
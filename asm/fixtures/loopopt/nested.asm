@@ -0,0 +1,14 @@
+// the inner loop gets its own register, the outer one hoists around it
+start:
+    mov r1, 0
+outer:
+    mov r2, 0
+inner:
+    add r2, 1
+    cmp r2, 100
+    bne inner
+    add r1, 1
+    cmp r1, 1000
+    bne outer
+die:
+    b   die
@@ -0,0 +1,11 @@
+// a pc relative branch with an immediate offset, nothing is hoisted
+start:
+    mov r1, 0
+loop:
+    add r1, 1
+    cmp r1, 1000
+    bne loop
+    beq 1
+    nop
+die:
+    b   die
@@ -0,0 +1,18 @@
+// a loop inside a function returning with b lr, with a value live after the
+// call that the loop may not take
+start:
+    mov r4, 7
+    mov r1, 0x8000
+    bl  clear
+    str r4, r1
+die:
+    b   die
+
+clear:
+    mov r2, 0
+clear_loop:
+    str r0, r1, r2
+    add r2, 1
+    cmp r2, 0x200
+    bne clear_loop
+    b   lr
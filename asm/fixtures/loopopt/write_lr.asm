@@ -0,0 +1,10 @@
+// an alu write to lr can send control anywhere, nothing is hoisted
+start:
+    mov r1, 0
+loop:
+    add r1, 1
+    cmp r1, 1000
+    bne loop
+    mov lr, r1
+die:
+    b   die
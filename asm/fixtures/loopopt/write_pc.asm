@@ -0,0 +1,10 @@
+// an alu write to pc is a computed jump, nothing is hoisted
+start:
+    mov r1, 0
+loop:
+    add r1, 1
+    cmp r1, 1000
+    bne loop
+    add pc, r1, 0
+die:
+    b   die
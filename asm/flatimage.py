@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+
+# flat memory image
+#
+# the whole 64K word address space as it sits in memory at reset, so
+# simulators and tools can map the file and use it in place instead of
+# parsing hex. the word array starts on a page boundary so it can be mapped
+# on its own, and the symbol map, if there is one, is tacked on the end.
+#
+# all fields are big endian, like the image itself:
+#
+# header (28 bytes):
+#   magic           '2IMG'
+#   version         16 bits, 1
+#   nsegs           16 bits, number of segment table entries
+#   entry           32 bits, word address of the entry point
+#   image offset    32 bits, byte offset of the word array in the file
+#   image words     32 bits, length of the word array, always 65536
+#   map offset      32 bits, byte offset of the symbol map, 0 if none
+#   map size        32 bits, size of the symbol map in bytes
+#
+# segment table, right after the header, nsegs of:
+#   start           32 bits, first word address
+#   length          32 bits, length in words
+#   flags           32 bits, SEG_CODE or SEG_DATA
+#
+# padding up to the image offset, then the word array: 16 bit big endian
+# words, zero past the end of the program. the symbol map is the same
+# format as a map file written by asm.py -m, see symmap.py.
+
+import argparse
+import array
+import mmap
+import struct
+import sys
+
+import symmap
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+FLAT_MAGIC = b'2IMG'
+FLAT_VERSION = 1
+
+HEADER = struct.Struct('>4sHHIIIII')
+SEGMENT = struct.Struct('>III')
+WORD = struct.Struct('>H')
+
+IMAGE_WORDS = 65536
+IMAGE_ALIGN = 4096
+
+# segment flags
+SEG_CODE = 1
+SEG_DATA = 2
+
+class FlatImageError(Exception):
+    pass
+
+# write a flat image. segments is a list of (start, length, flags) and
+# symbols the contents of a symbol map, or empty for none
+def write_flat(outfile, image : array.array, segments : list[tuple[int, int, int]], entry : int = 0, symbols : bytes = b''):
+    if len(image) > IMAGE_WORDS:
+        raise FlatImageError("image is %d words, more than the %d word address space" % (len(image), IMAGE_WORDS))
+
+    table_end = HEADER.size + SEGMENT.size * len(segments)
+    image_offset = -(-table_end // IMAGE_ALIGN) * IMAGE_ALIGN
+    map_offset = image_offset + IMAGE_WORDS * 2 if symbols else 0
+
+    outfile.write(HEADER.pack(FLAT_MAGIC, FLAT_VERSION, len(segments), entry,
+                              image_offset, IMAGE_WORDS, map_offset, len(symbols)))
+    for seg in segments:
+        outfile.write(SEGMENT.pack(*seg))
+    outfile.write(bytes(image_offset - table_end))
+
+    words = array.array('H', image)
+    words.extend(array.array('H', [0]) * (IMAGE_WORDS - len(image)))
+    if sys.byteorder == 'little':
+        words.byteswap()
+    outfile.write(words.tobytes())
+    outfile.write(symbols)
+
+class FlatImage:
+    def __init__(self, data) -> None:
+        self.data = memoryview(data)
+        if len(self.data) < HEADER.size:
+            raise FlatImageError("image file too short")
+
+        magic, version, nsegs, self.entry, image_offset, image_words, map_offset, map_size = HEADER.unpack_from(self.data)
+        if magic != FLAT_MAGIC:
+            raise FlatImageError("bad image file magic")
+        if version != FLAT_VERSION:
+            raise FlatImageError("unsupported image file version %d" % version)
+        if image_words != IMAGE_WORDS:
+            raise FlatImageError("image file has %d words, expected %d" % (image_words, IMAGE_WORDS))
+        if HEADER.size + SEGMENT.size * nsegs > image_offset or image_offset + IMAGE_WORDS * 2 > len(self.data):
+            raise FlatImageError("image file size does not match header")
+        if map_size and map_offset + map_size > len(self.data):
+            raise FlatImageError("symbol map runs past the end of the image file")
+
+        self.segments = [ SEGMENT.unpack_from(self.data, HEADER.size + SEGMENT.size * i) for i in range(nsegs) ]
+
+        # the raw big endian word array, straight out of the file
+        self.memory = self.data[image_offset:image_offset + IMAGE_WORDS * 2]
+        self.map_data = self.data[map_offset:map_offset + map_size] if map_size else None
+
+    @classmethod
+    def open(cls, path : str) -> 'FlatImage':
+        with open(path, 'rb') as f:
+            if f.seek(0, 2) == 0:
+                raise FlatImageError("image file too short")
+            return cls(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def word(self, addr : int) -> int:
+        return WORD.unpack_from(self.memory, addr * 2)[0]
+
+    # the word array as a numpy array, sharing memory with the file
+    def view(self):
+        if numpy is None:
+            raise FlatImageError("numpy is not installed")
+        return numpy.frombuffer(self.memory, dtype='>u2')
+
+    # the word array as a native array.array, for when numpy isn't around. this one is a copy
+    def words(self) -> array.array:
+        words = array.array('H')
+        words.frombytes(self.memory)
+        if sys.byteorder == 'little':
+            words.byteswap()
+        return words
+
+    def symbols(self) -> symmap.SymbolMap | None:
+        if self.map_data is None:
+            return None
+        return symmap.SymbolMap(self.map_data)
+
+def main():
+    parser = argparse.ArgumentParser(description="inspect a flat image generated by asm.py -F")
+    parser.add_argument('image', help="flat image file")
+    parser.add_argument('addr', nargs='*', help="addresses to dump")
+
+    args = parser.parse_args()
+
+    img = FlatImage.open(args.image)
+    syms = img.symbols()
+    if not args.addr:
+        print("entry 0x%04x%s" % (img.entry, " %s" % syms.describe(img.entry) if syms else ""))
+        for start, length, flags in img.segments:
+            print("0x%04x-0x%04x %s" % (start, start + length - 1, "code" if flags & SEG_CODE else "data"))
+        if syms:
+            print("symbol map, %d symbols" % len(syms.sym_addr))
+    for a in args.addr:
+        addr = int(a, 0)
+        print("0x%04x %04x %s" % (addr, img.word(addr), syms.describe(addr) if syms else ""))
+
+if __name__ == "__main__":
+    main()
+
+# vim: ts=4 sw=4 expandtab:
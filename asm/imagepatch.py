@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+
+# differential image patches
+#
+# a patch turns an old binary image into a new one by rewriting only the
+# address ranges that changed. everything is stored as big endian 16 bit
+# words, the same as the .bin output, so a loader on the target can walk it
+# without any byte shuffling.
+#
+# header (5 words):
+#   0x5032          magic, 'P2'
+#   0x0002          version
+#   length hi       length of the new image in words, 0 to 65536,
+#   length lo       as a 32 bit value
+#   count           number of records that follow
+#
+# record:
+#   addr            first word address of the range
+#   ctl             bit 15: fill flag, bits 14..0: run length in words (1..32767)
+#   data...         fill: one word repeated run length times
+#                   otherwise: run length words copied in order
+#
+# the applier first truncates or zero extends the old image to the new length,
+# then applies each record in order.
+
+import argparse
+import array
+import struct
+import sys
+
+PATCH_MAGIC = 0x5032
+PATCH_VERSION = 2
+HEADER_WORDS = 5
+
+MAX_RUN = 0x7fff
+FILL_FLAG = 0x8000
+
+# unchanged words shorter than this between two changed ranges get folded into
+# a single record, since a new record costs two words of overhead
+MERGE_GAP = 2
+
+# shortest run of identical words worth encoding as a fill record
+MIN_FILL = 3
+
+class PatchError(Exception):
+    pass
+
+def read_image(infile) -> array.array:
+    data = infile.read()
+    if len(data) % 2:
+        raise PatchError("image has odd length %d" % len(data))
+    words = array.array('H', data)
+    if sys.byteorder == 'little':
+        words.byteswap()
+    return words
+
+def write_image(outfile, words : array.array):
+    out = array.array('H', words)
+    if sys.byteorder == 'little':
+        out.byteswap()
+    outfile.write(out.tobytes())
+
+# find the [start, end) ranges of words that differ between the two images
+def changed_ranges(old : array.array, new : array.array) -> list[tuple[int, int]]:
+    ranges : list[tuple[int, int]] = []
+    oldlen = len(old)
+    start = -1
+    end = 0
+    for addr in range(len(new)):
+        if addr < oldlen and old[addr] == new[addr]:
+            continue
+        if start >= 0 and addr - end < MERGE_GAP:
+            end = addr + 1
+            continue
+        if start >= 0:
+            ranges.append((start, end))
+        start = addr
+        end = addr + 1
+    if start >= 0:
+        ranges.append((start, end))
+    return ranges
+
+# split a changed range into copy and fill records
+def encode_range(new : array.array, start : int, end : int, out : list[int]) -> int:
+    records = 0
+    addr = start
+    copy_start = start
+    while addr < end:
+        # measure the run of identical words at this address
+        run = 1
+        while addr + run < end and new[addr + run] == new[addr] and run < MAX_RUN:
+            run += 1
+
+        if run < MIN_FILL:
+            addr += run
+            continue
+
+        # flush any pending copy, then emit the fill
+        records += encode_copy(new, copy_start, addr, out)
+        out += [ addr, FILL_FLAG | run, new[addr] ]
+        records += 1
+        addr += run
+        copy_start = addr
+
+    records += encode_copy(new, copy_start, end, out)
+    return records
+
+def encode_copy(new : array.array, start : int, end : int, out : list[int]) -> int:
+    records = 0
+    while start < end:
+        run = min(end - start, MAX_RUN)
+        out += [ start, run ]
+        out += new[start:start + run]
+        start += run
+        records += 1
+    return records
+
+# build a patch that turns old into new
+def make_patch(old : array.array, new : array.array) -> bytes:
+    if len(new) > 0x10000:
+        raise PatchError("image too large, %d words" % len(new))
+
+    body : list[int] = []
+    records = 0
+    for start, end in changed_ranges(old, new):
+        records += encode_range(new, start, end, body)
+
+    if records > 0xffff:
+        raise PatchError("too many patch records, %d" % records)
+
+    words = array.array('H', [ PATCH_MAGIC, PATCH_VERSION, len(new) >> 16, len(new) & 0xffff, records ])
+    words.extend(body)
+    if sys.byteorder == 'little':
+        words.byteswap()
+    return words.tobytes()
+
+# reference applier, returns a new image
+def apply_patch(old : array.array, patch : bytes) -> array.array:
+    if len(patch) % 2:
+        raise PatchError("patch has odd length %d" % len(patch))
+
+    words = array.array('H', patch)
+    if sys.byteorder == 'little':
+        words.byteswap()
+
+    if len(words) < HEADER_WORDS or words[0] != PATCH_MAGIC:
+        raise PatchError("bad patch magic")
+    if words[1] != PATCH_VERSION:
+        raise PatchError("unsupported patch version %d" % words[1])
+
+    length = words[2] << 16 | words[3]
+    records = words[4]
+    if length > 0x10000:
+        raise PatchError("bad patch image length %d" % length)
+
+    image = array.array('H', old[:length])
+    if len(image) < length:
+        image.extend(array.array('H', [0]) * (length - len(image)))
+
+    pos = HEADER_WORDS
+    for _ in range(records):
+        if pos + 2 > len(words):
+            raise PatchError("truncated patch record")
+        addr = words[pos]
+        ctl = words[pos + 1]
+        run = ctl & MAX_RUN
+        pos += 2
+        if run == 0 or addr + run > length:
+            raise PatchError("patch record out of range, addr 0x%04x run %d" % (addr, run))
+
+        if ctl & FILL_FLAG:
+            if pos >= len(words):
+                raise PatchError("truncated patch record")
+            image[addr:addr + run] = array.array('H', [words[pos]]) * run
+            pos += 1
+        else:
+            if pos + run > len(words):
+                raise PatchError("truncated patch record")
+            image[addr:addr + run] = words[pos:pos + run]
+            pos += run
+
+    if pos != len(words):
+        raise PatchError("trailing data after %d patch records" % records)
+
+    return image
+
+def main():
+    parser = argparse.ArgumentParser(description="apply an image patch generated by asm.py --diff-against")
+    parser.add_argument('old', type=argparse.FileType('rb'), help="old binary image")
+    parser.add_argument('patch', type=argparse.FileType('rb'), help="patch file")
+    parser.add_argument('-o','--out', nargs=1, type=argparse.FileType('wb'), required=True, help="output binary")
+
+    args = parser.parse_args()
+
+    image = apply_patch(read_image(args.old), args.patch.read())
+    write_image(args.out[0], image)
+    args.out[0].close()
+
+if __name__ == "__main__":
+    main()
+
+# vim: ts=4 sw=4 expandtab:
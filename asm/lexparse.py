@@ -3,6 +3,9 @@ import codegen
 
 gen : codegen.Codegen
 
+# name to report for the preprocessor's <stdin>, set by the driver
+stdin_name : str = "<stdin>"
+
 # lexer
 tokens = (
     'NUM',
@@ -147,6 +150,7 @@ def p_expr(p):
 def p_label(p):
     '''label        : ID ':' '''
     label = p[1][1]
+    gen.cur_line = p.lineno(1)
     # print("parser label %s, line %d" % (label, p.lineno(1)))
     gen.add_label(label)
 
@@ -162,6 +166,7 @@ def p_instruction_3addr(p):
                             | INSTRUCTION REGISTER ',' REGISTER ',' ID'''
     # print("parser instruction 3addr %s" % p[1])
 
+    gen.cur_line = p.lineno(1)
     gen.add_instruction(p[1], (p[2], p[4], p[6]))
 
 def p_instruction_2addr(p):
@@ -169,6 +174,7 @@ def p_instruction_2addr(p):
                             | INSTRUCTION REGISTER ',' REGISTER
                             | INSTRUCTION REGISTER ',' ID'''
     # print("parser instruction 2addr %s" % p[1])
+    gen.cur_line = p.lineno(1)
     gen.add_instruction(p[1], (p[2], p[4]))
 
 def p_instruction_1addr(p):
@@ -176,11 +182,13 @@ def p_instruction_1addr(p):
                             | INSTRUCTION NUM
                             | INSTRUCTION ID'''
     # print("parser instruction 1addr %s" % p[1])
+    gen.cur_line = p.lineno(1)
     gen.add_instruction(p[1], (p[2], ))
 
 def p_instruction_0addr(p):
     '''instruction_0addr    : INSTRUCTION'''
     # print("parser instruction 0addr %s" % p[1])
+    gen.cur_line = p.lineno(1)
     gen.add_instruction(p[1], ())
 
 def p_directive(p):
@@ -189,6 +197,7 @@ def p_directive(p):
                             | DIRECTIVE STRING
                             | DIRECTIVE NUM'''
     # print("parser directive %s" % p[1])
+    gen.cur_line = p.lineno(1)
     if len(p) == 3:
         gen.add_directive(p[1], (p[2], ))
     else:
@@ -202,8 +211,11 @@ def p_preprocessor_directive(p):
                             | '#' NUM STRING NUM NUM NUM NUM'''
     # print("parser preprocessor_directive, %s line %d" % (p[2], p.lineno(2)))
 
-    # set the lineno to the number
+    # set the lineno to the number, and remember which file we're in
     p.lexer.lineno = int(p[2][1])
+    gen.cur_file = stdin_name if p[3] == "<stdin>" else p[3]
+    if not gen.cur_file.startswith("<") and gen.cur_file not in gen.files:
+        gen.files.append(gen.cur_file)
 
 #def p_empty(p):
     #'empty : '
@@ -0,0 +1,519 @@
+# loop invariant hoisting of wide immediates
+#
+# an alu instruction with a 16 bit immediate or a label address in its b slot
+# is two words long and spends an extra IR_IMMEDIATE cycle fetching the second
+# one. inside a loop that's paid on every iteration, so if there's a register
+# the loop never touches, the value is loaded into it once in front of the
+# loop and the uses are rewritten to the one word register form:
+#
+#   wait:                       wait:
+#       ldr  r5, r6, 3              mov  r7, 0xff
+#       and  r5, 0xff           wait.loop:
+#       beq  wait                   ldr  r5, r6, 3
+#                                   and  r5, r7
+#                                   beq  wait.loop
+#
+# works on the instruction stream before fixups are applied. loops are natural
+# loops found from backwards branches, innermost first. a register is free for
+# a loop if nothing in the loop, or in anything it calls, reads or writes it,
+# and it isn't live on entry. liveness is worked out over the whole program,
+# following bl into the callee and b lr back out to every call site of it.
+#
+# labels on the loop header stay in front of the new instructions, so every
+# way into the loop goes through them, and the branches inside the loop that
+# go back to the top are pointed at a new '<header>.loop' symbol instead.
+#
+# nothing is done if the program has control flow that can't be followed:
+# pc relative branches with immediate offsets, branches through any register
+# but lr, or alu instructions that write pc or lr.
+
+from codegen import Codegen, Instruction, OutputData, Symbol, FIXUP_TYPE, branch_target
+
+SHORT_MIN = -256
+SHORT_MAX = 255
+
+# r1-r7 as a bit mask, r0 always reads as zero
+ALL_REGS = 0xfe
+
+OP_MOV = 0b00000
+OP_STR = 0b01101
+
+# special register numbers, as encoded in the d and a fields
+SPECIAL_LR = 0
+SPECIAL_PC = 2
+
+# kinds of instruction, as far as control flow goes
+ALU = 0
+COND = 1    # conditional branch to a label
+JUMP = 2    # b label
+CALL = 3    # bl label
+RET = 4     # b lr
+DATA = 5
+
+# registers read and written by an alu instruction, as masks
+def alu_regs(op : int) -> tuple[int, int]:
+    d = (op >> 8) & 0x7
+    a = (op >> 5) & 0x7
+    bmode = (op >> 3) & 0x3
+    d_special = bmode == 0b11 and op & (1 << 1)
+    a_special = bmode == 0b11 and op & (1 << 0)
+
+    uses = 0
+    defs = 0
+    if not a_special:
+        uses |= 1 << a
+    if bmode == 0b10:
+        uses |= 1 << (op & 0x7)
+    if (op >> 11) == OP_STR:
+        if not d_special:
+            uses |= 1 << d
+    elif not d_special:
+        defs |= 1 << d
+    return (uses & ALL_REGS, defs & ALL_REGS)
+
+# the value in the b slot of a two word alu instruction with no special
+# registers, or None if it isn't one
+def wide_operand(out : OutputData) -> tuple[str, int | str] | None:
+    if not isinstance(out, Instruction) or out.length != 2 or (out.op >> 14) == 0b10:
+        return None
+    if (out.op >> 3) & 0x3 != 0b11 or not out.op & (1 << 2) or out.op & 0x3:
+        return None
+    if out.fixup_type == FIXUP_TYPE.NONE:
+        return ('NUMBER', out.op2)
+    if out.fixup_type == FIXUP_TYPE.SYMBOL_LONG and out.fixup_sym is not None:
+        return ('ID', out.fixup_sym.name)
+    return None
+
+def operand_string(value : tuple[str, int | str]) -> str:
+    return "%#x" % value[1] if value[0] == 'NUMBER' else str(value[1])
+
+class Loop:
+    def __init__(self, header : int, body : set[int]) -> None:
+        self.header = header
+        self.body = body
+
+        # filled in once something is hoisted
+        self.sym : Symbol | None = None
+        self.preheader : list[Instruction] = []
+        self.rewritten : dict[int, Instruction] = {}
+        self.retargeted : list[OutputData] = []
+        self.values : list[tuple[str, int, int]] = []   # (value, register, uses)
+
+    # each rewritten use is one less IR_IMMEDIATE cycle per trip around the loop
+    def cycles(self) -> int:
+        return len(self.rewritten)
+
+class LoopReport:
+    def __init__(self) -> None:
+        self.loops : list[tuple[str, int, list[tuple[str, int, int]], int]] = []
+        self.skipped = ""
+        self.words = 0
+
+    def __str__(self):
+        if self.skipped:
+            return "loops: nothing hoisted, %s" % self.skipped
+        lines = []
+        for name, addr, values, cycles in self.loops:
+            hoisted = [ "%s in r%d (%d use%s)" % (value, reg, uses, "" if uses == 1 else "s") for value, reg, uses in values ]
+            lines.append("loops: %s at 0x%04x, %s, %d cycles per iteration saved" % (
+                         name, addr, ", ".join(hoisted), cycles))
+        lines.append("loops: %d loops, %d values hoisted, %d uses rewritten, %+d words" % (
+                     len(self.loops), sum(len(l[2]) for l in self.loops),
+                     sum(l[3] for l in self.loops), self.words))
+        return "\n".join(lines)
+
+class LoopOptimizer:
+    def __init__(self, code : Codegen) -> None:
+        self.code = code
+        self.report = LoopReport()
+        self.outs = code.output
+        n = len(self.outs)
+
+        # index of the output each symbol points at, n for the end of the program
+        first_at : dict[int, int] = {}
+        for i in range(n - 1, -1, -1):
+            first_at[self.outs[i].addr] = i
+        self.sym_index : dict[str, int] = {}
+        for sym in code.symbols.values():
+            if sym.resolved:
+                self.sym_index[sym.name] = first_at.get(sym.addr, n)
+
+        self.kind = [ ALU ] * n
+        self.target = [ -1 ] * n
+        self.uses = [ 0 ] * n
+        self.defs = [ 0 ] * n
+
+    # decode every output, returns a reason if the control flow can't be followed
+    def decode(self) -> str | None:
+        for i, out in enumerate(self.outs):
+            if not isinstance(out, Instruction):
+                self.kind[i] = DATA
+                continue
+            if branch_target(out) is not None:
+                return "pc relative branch with an immediate offset at 0x%04x" % out.addr
+
+            op = out.op
+            opcode = op >> 11
+            if (op >> 14) == 0b10:
+                cc = (op >> 10) & 0xf
+                link = cc == 0b1111 and op & (1 << 9)
+                if out.fixup_type in (FIXUP_TYPE.SHORT_BRANCH, FIXUP_TYPE.LONG_BRANCH):
+                    if out.fixup_sym is None or not out.fixup_sym.resolved:
+                        return "branch to an unresolved symbol at 0x%04x" % out.addr
+                    self.target[i] = self.sym_index[out.fixup_sym.name]
+                    if link:
+                        self.kind[i] = CALL
+                    elif cc >= 0b1110:
+                        self.kind[i] = JUMP
+                    else:
+                        self.kind[i] = COND
+                elif cc == 0b1111 and not link and op & 0xf == (0b1000 | SPECIAL_LR):
+                    # b lr
+                    self.kind[i] = RET
+                else:
+                    return "branch through a register at 0x%04x" % out.addr
+            elif opcode <= OP_STR:
+                if opcode != OP_STR and (op >> 3) & 0x3 == 0b11 and op & (1 << 1) and \
+                   ((op >> 8) & 0x3) in (SPECIAL_LR, SPECIAL_PC):
+                    return "write to lr or pc at 0x%04x" % out.addr
+                self.uses[i], self.defs[i] = alu_regs(op)
+            else:
+                return "unknown instruction at 0x%04x" % out.addr
+        return None
+
+    # successors within a function, a bl just carries on to the next instruction
+    def local_succ(self, i : int) -> list[int]:
+        k = self.kind[i]
+        if k == ALU or k == CALL:
+            return [ i + 1 ]
+        elif k == COND:
+            return [ self.target[i], i + 1 ]
+        elif k == JUMP:
+            return [ self.target[i] ]
+        return []
+
+    def reach(self, starts : list[int], calls : bool) -> set[int]:
+        n = len(self.outs)
+        seen : set[int] = set()
+        work = list(starts)
+        while work:
+            i = work.pop()
+            if i in seen:
+                continue
+            seen.add(i)
+            if i >= n:
+                continue
+            work.extend(self.local_succ(i))
+            if calls and self.kind[i] == CALL:
+                work.append(self.target[i])
+        return seen
+
+    def build(self):
+        n = len(self.outs)
+
+        # every function is entered by a bl, and its b lr goes back to all the callers
+        callers : dict[int, list[int]] = {}
+        for i in range(n):
+            if self.kind[i] == CALL:
+                callers.setdefault(self.target[i], []).append(i + 1)
+        self.ret_succ : dict[int, list[int]] = {}
+        self.ret_unknown : set[int] = set()
+        for entry, returns in callers.items():
+            for i in self.reach([ entry ], False):
+                if i < n and self.kind[i] == RET:
+                    self.ret_succ.setdefault(i, []).extend(returns)
+        for i in self.reach([ 0 ], False):
+            if i < n and self.kind[i] == RET:
+                self.ret_unknown.add(i)
+
+        # besides the local predecessors, code can be entered at reset, by a
+        # bl, or through a label whose address is taken
+        self.preds : list[list[int]] = [ [] for _ in range(n + 1) ]
+        for i in range(n):
+            for s in self.local_succ(i):
+                self.preds[s].append(i)
+        self.called = { self.target[i] for i in range(n) if self.kind[i] == CALL }
+        self.taken = { self.sym_index[out.fixup_sym.name] for out in self.outs
+                       if out.fixup_type in (FIXUP_TYPE.SYMBOL_LONG, FIXUP_TYPE.DATA_SYMBOL_LONG) and
+                          out.fixup_sym is not None and out.fixup_sym.resolved }
+        self.entered = self.called | self.taken | { 0 }
+
+        self.func_nodes : dict[int, set[int] | None] = {}
+        self.hoisted_at : set[int] = set()
+        self.preheader_defs : dict[int, int] = {}
+
+    # registers live on entry to each instruction
+    def liveness(self):
+        n = len(self.outs)
+        succ : list[list[int]] = [ [] for _ in range(n) ]
+        preds : list[list[int]] = [ [] for _ in range(n + 1) ]
+        for i in range(n):
+            k = self.kind[i]
+            if k == CALL:
+                succ[i] = [ self.target[i] ]
+            elif k == RET:
+                succ[i] = self.ret_succ.get(i, [])
+            else:
+                succ[i] = self.local_succ(i)
+            for s in succ[i]:
+                preds[s].append(i)
+
+        # falling off the end, into data, or returning to somewhere unknown
+        # could go anywhere, so everything is live there
+        live = [ 0 ] * (n + 1)
+        live[n] = ALL_REGS
+        fixed = [ False ] * n
+        for i in range(n):
+            if self.kind[i] == DATA or i in self.ret_unknown or (self.kind[i] == RET and i not in self.ret_succ):
+                live[i] = ALL_REGS
+                fixed[i] = True
+
+        work = list(range(n))
+        queued = [ True ] * n
+        while work:
+            i = work.pop()
+            queued[i] = False
+            if not fixed[i]:
+                out = 0
+                for s in succ[i]:
+                    out |= live[s]
+                new = self.uses[i] | (out & ~self.defs[i])
+                if new == live[i]:
+                    continue
+                live[i] = new
+            for p in preds[i]:
+                if not queued[p]:
+                    queued[p] = True
+                    work.append(p)
+        self.live = live
+        self.live_preds = preds
+
+    # a register loaded in front of a loop is live from there to every use of
+    # it, which may be inside functions the loop calls
+    def add_live(self, reg : int, uses : list[int], loop : Loop):
+        bit = 1 << reg
+        work = list(uses)
+        while work:
+            i = work.pop()
+            if self.live[i] & bit:
+                continue
+            self.live[i] |= bit
+            for p in self.live_preds[i]:
+                if i == loop.header and p not in loop.body:
+                    continue
+                if not self.defs[p] & bit:
+                    work.append(p)
+
+    # natural loops, smallest first
+    def find_loops(self) -> list[Loop]:
+        n = len(self.outs)
+        latches : dict[int, list[int]] = {}
+        for i in range(n):
+            if self.kind[i] in (COND, JUMP) and self.target[i] <= i:
+                latches.setdefault(self.target[i], []).append(i)
+
+        loops = []
+        for header, ends in latches.items():
+            body = { header }
+            work = list(ends)
+            while work:
+                i = work.pop()
+                if i in body:
+                    continue
+                body.add(i)
+                work.extend(self.preds[i])
+
+            # has to be a single entry loop, with nothing falling into the
+            # header from inside that would end up running the preheader
+            if self.kind[header] == DATA or header in self.called or header in self.taken:
+                continue
+            if any(i in self.entered or any(p not in body for p in self.preds[i]) for i in body if i != header):
+                continue
+            if header > 0 and header - 1 in body and self.kind[header - 1] not in (JUMP, RET):
+                continue
+            loops.append(Loop(header, body))
+
+        loops.sort(key=lambda l: len(l.body))
+        return loops
+
+    # everything a bl to entry may run, None if it can wander off somewhere unknown
+    def function(self, entry : int) -> set[int] | None:
+        if entry not in self.func_nodes:
+            nodes : set[int] | None = self.reach([ entry ], True)
+            n = len(self.outs)
+            if any(i >= n or self.kind[i] == DATA for i in nodes): # type: ignore
+                nodes = None
+            self.func_nodes[entry] = nodes
+        return self.func_nodes[entry]
+
+    # registers touched by the loop or anything it calls
+    def loop_regs(self, loop : Loop) -> int:
+        nodes = set(loop.body)
+        for i in loop.body:
+            if self.kind[i] == CALL:
+                f = self.function(self.target[i])
+                if f is None:
+                    return ALL_REGS
+                nodes |= f
+        regs = 0
+        for i in nodes:
+            regs |= self.uses[i] | self.defs[i] | self.preheader_defs.get(i, 0)
+        return regs
+
+    def new_symbol(self, name : str) -> Symbol:
+        base = "%s.loop" % name
+        name = base
+        count = 1
+        while name in self.code.symbols:
+            count += 1
+            name = "%s%d" % (base, count)
+        sym = Symbol(name)
+        sym.resolved = True
+        return sym
+
+    def hoist(self, loop : Loop) -> bool:
+        # group the wide operands in the loop by value
+        found : dict[tuple[str, int | str], list[int]] = {}
+        for i in sorted(loop.body):
+            if i in self.hoisted_at:
+                continue
+            value = wide_operand(self.outs[i])
+            if value is not None:
+                found.setdefault(value, []).append(i)
+        if not found:
+            return False
+
+        free = ALL_REGS & ~(self.loop_regs(loop) | self.live[loop.header])
+        if not free:
+            return False
+
+        header_names = [ name for name, i in self.sym_index.items() if i == loop.header ]
+        header_out = self.outs[loop.header]
+        loop.sym = self.new_symbol(header_names[0] if header_names else "loop_%04x" % header_out.addr)
+
+        # most used values get the registers, highest register first
+        regs = [ r for r in range(7, 0, -1) if free & (1 << r) ]
+        for value, uses in sorted(found.items(), key=lambda v: -len(v[1]))[:len(regs)]:
+            reg = regs[len(loop.values)]
+
+            mov = Instruction()
+            mov.op = (OP_MOV << 11) | (reg << 8) | (0b11 << 3) | (1 << 2)
+            mov.length = 2
+            mov.string = "mov r%d, %s" % (reg, operand_string(value))
+            mov.file = header_out.file
+            mov.line = header_out.line
+            if value[0] == 'NUMBER':
+                mov.op2 = value[1] # type: ignore
+            else:
+                mov.fixup_type = FIXUP_TYPE.SYMBOL_LONG
+                mov.fixup_sym = self.outs[uses[0]].fixup_sym
+            loop.preheader.append(mov)
+
+            for i in uses:
+                out = self.outs[i]
+                ins = Instruction()
+                ins.op = (out.op & ~0x1f) | (0b10 << 3) | reg # type: ignore
+                ins.length = 1
+                ins.string = "%s, r%d" % (out.string.rsplit(',', 1)[0], reg)
+                ins.file = out.file
+                ins.line = out.line
+                loop.rewritten[i] = ins
+
+                self.hoisted_at.add(i)
+                self.uses[i] |= 1 << reg
+            self.preheader_defs[loop.header] = self.preheader_defs.get(loop.header, 0) | (1 << reg)
+            self.add_live(reg, uses, loop)
+            loop.values.append((operand_string(value), reg, len(uses)))
+
+        # branches back to the top skip the preheader
+        header_syms = set(header_names)
+        for i in loop.body:
+            out = self.outs[i]
+            if self.kind[i] in (COND, JUMP) and out.fixup_sym is not None and out.fixup_sym.name in header_syms:
+                loop.retargeted.append(out)
+
+        return True
+
+    # lay out the hoisted loops, returns the new output list and symbol addresses,
+    # or None if a short branch would end up out of range
+    def layout(self, loops : list[Loop]) -> tuple[list[OutputData], dict[Symbol, int]] | None:
+        preheaders = { l.header: l for l in loops }
+        rewritten : dict[int, Instruction] = {}
+        retarget : dict[int, Symbol] = {}
+        for l in loops:
+            rewritten.update(l.rewritten)
+            for out in l.retargeted:
+                retarget[id(out)] = l.sym # type: ignore
+
+        output : list[OutputData] = []
+        index_addr : list[int] = []
+        sym_addr : dict[Symbol, int] = {}
+        addr = 0
+        for i, out in enumerate(self.outs):
+            index_addr.append(addr)
+            if i in preheaders:
+                for mov in preheaders[i].preheader:
+                    mov.addr = addr
+                    addr += mov.length
+                    output.append(mov)
+                sym_addr[preheaders[i].sym] = addr # type: ignore
+            out = rewritten.get(i, out)
+            out.addr = addr
+            addr += out.length
+            output.append(out)
+        index_addr.append(addr)
+
+        for sym in self.code.symbols.values():
+            if sym.resolved:
+                sym_addr[sym] = index_addr[self.sym_index[sym.name]]
+
+        for out in output:
+            if out.fixup_type != FIXUP_TYPE.SHORT_BRANCH or out.fixup_sym is None:
+                continue
+            sym = retarget.get(id(out), out.fixup_sym)
+            offset = sym_addr[sym] - (out.addr + 1)
+            if offset < SHORT_MIN or offset > SHORT_MAX:
+                return None
+        return (output, sym_addr)
+
+    def run(self) -> LoopReport:
+        reason = self.decode()
+        if reason is not None:
+            self.report.skipped = reason
+            return self.report
+
+        self.build()
+        self.liveness()
+        hoisted = [ l for l in self.find_loops() if self.hoist(l) ]
+
+        # growing the preheaders can push short branches out of reach, give
+        # up on the outermost loops until everything fits again
+        while True:
+            result = self.layout(hoisted)
+            if result is not None or not hoisted:
+                break
+            hoisted.pop()
+        if result is None:
+            return self.report
+        output, sym_addr = result
+
+        old_length = self.code.cur_addr
+        for l in hoisted:
+            for out in l.retargeted:
+                out.fixup_sym = l.sym
+                out.string = "%s %s" % (out.string.split()[0], l.sym.name) # type: ignore
+            self.code.symbols[l.sym.name] = l.sym # type: ignore
+        for sym, addr in sym_addr.items():
+            sym.addr = addr
+        self.code.output = output
+        self.code.cur_addr = sum(out.length for out in output)
+
+        for l in sorted(hoisted, key=lambda l: l.sym.addr): # type: ignore
+            self.report.loops.append((l.sym.name, l.sym.addr, l.values, l.cycles())) # type: ignore
+        self.report.words = self.code.cur_addr - old_length
+        return self.report
+
+def optimize(code : Codegen) -> LoopReport:
+    return LoopOptimizer(code).run()
+
+# vim: ts=4 sw=4 expandtab:
@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+
+# streaming analyzer for simulator traces
+#
+# understands two kinds of input, both read a line at a time so traces of any
+# size can be fed through (including from a pipe):
+#
+#   memtrace    the output of rtl/sim.cpp built with MEMTRACE set, one line per
+#               memory access:  "<time> R|W <instance>: addr 0x<addr>, data 0x<data>"
+#   vcd         a waveform dump from the vcd target in rtl/makefile. the cpu's
+#               clk, rst, state, pc and ir signals are sampled on each rising
+#               clock edge.
+#
+# given the source file the image was built from, hot addresses are mapped back
+# to the nearest label and the source line that generated them. the source is
+# reassembled to do that, so it has to be built with the same --gc,
+# --opt-branches and --hoist-loops options as the image, or every address
+# after the first change maps to the wrong place.
+
+import argparse
+import bisect
+import contextlib
+import sys
+from collections import Counter
+
+import asm
+import codegen
+
+# must match state_t in rtl/cpu.v
+CPU_STATES = [ 'DECODE', 'IR_IMMEDIATE', 'LS1', 'LS2', 'BRANCH_DELAY' ]
+
+OP_LOAD = 0b01100
+OP_STORE = 0b01101
+
+# simulation time units per clock, sim.cpp steps 5 per clock edge
+MEMTRACE_CLOCK_PERIOD = 10
+
+class TraceError(Exception):
+    pass
+
+# maps addresses back to labels and source lines of an assembled program
+class Symbolizer:
+    def __init__(self, code : codegen.Codegen | None = None) -> None:
+        self.sym_addrs : list[int] = []
+        self.sym_names : list[str] = []
+        self.out_addrs : list[int] = []
+        self.outputs : list[codegen.OutputData] = []
+        self.end = 0
+
+        if code is None:
+            return
+
+        syms = sorted((s.addr, s.name) for s in code.symbols.values() if s.resolved)
+        self.sym_addrs = [ s[0] for s in syms ]
+        self.sym_names = [ s[1] for s in syms ]
+        self.out_addrs = [ o.addr for o in code.output ]
+        self.outputs = code.output
+        self.end = code.cur_addr
+
+    def output_at(self, addr : int) -> codegen.OutputData | None:
+        i = bisect.bisect_right(self.out_addrs, addr) - 1
+        if i < 0:
+            return None
+        out = self.outputs[i]
+        if addr >= out.addr + out.length:
+            return None
+        return out
+
+    def symbol(self, addr : int) -> str:
+        i = bisect.bisect_right(self.sym_addrs, addr) - 1
+        if i < 0 or addr >= self.end:
+            return ""
+        offset = addr - self.sym_addrs[i]
+        if offset == 0:
+            return self.sym_names[i]
+        return "%s+%#x" % (self.sym_names[i], offset)
+
+    def location(self, addr : int) -> str:
+        out = self.output_at(addr)
+        if out is None or out.line == 0:
+            return ""
+        return "%s:%d" % (out.file, out.line)
+
+    def text(self, addr : int) -> str:
+        out = self.output_at(addr)
+        return out.string if out is not None else ""
+
+class TraceStats:
+    def __init__(self) -> None:
+        self.cycles = 0
+        self.instructions = 0
+        self.bubbles = 0
+        self.states : Counter[str] = Counter()
+        self.fetches : Counter[int] = Counter()
+        self.pc_cycles : Counter[int] = Counter()
+        self.loads : Counter[int] = Counter()
+        self.stores : Counter[int] = Counter()
+        self.reads : Counter[int] = Counter()
+        self.writes : Counter[int] = Counter()
+
+def parse_memtrace(infile, sym : Symbolizer) -> TraceStats:
+    stats = TraceStats()
+    first = -1
+    last = -1
+    have_image = len(sym.outputs) > 0
+
+    for line in infile:
+        # <time> R|W <instance>: addr 0x<addr>, data 0x<data>
+        fields = line.split()
+        if len(fields) < 5 or fields[1] not in ('R', 'W'):
+            continue
+        try:
+            now = int(fields[0])
+            addr = int(fields[4].rstrip(','), 16)
+        except ValueError:
+            continue
+
+        if first < 0:
+            first = now
+        last = now
+
+        if fields[1] == 'W':
+            stats.writes[addr] += 1
+            stats.stores[addr] += 1
+        else:
+            stats.reads[addr] += 1
+            # without an image every read looks like a fetch
+            if not have_image:
+                stats.fetches[addr] += 1
+                continue
+            out = sym.output_at(addr)
+            if isinstance(out, codegen.Instruction):
+                stats.fetches[addr] += 1
+                # a fetch of the first word is an instruction, the second word is its immediate.
+                # a fetch thrown away after a taken branch still counts
+                if out.addr == addr:
+                    stats.instructions += 1
+            else:
+                stats.loads[addr] += 1
+
+    if first >= 0:
+        stats.cycles = (last - first) // MEMTRACE_CLOCK_PERIOD + 1
+    return stats
+
+class VcdSignal:
+    def __init__(self, name : str, scope : str, width : int) -> None:
+        self.name = name
+        self.scope = scope
+        self.width = width
+
+def vcd_value(s : str) -> int | None:
+    try:
+        return int(s, 2)
+    except ValueError:
+        return None # x or z
+
+def parse_vcd(infile, sym : Symbolizer, cpu_scope : str = "") -> TraceStats:
+    stats = TraceStats()
+
+    # parse the header, collecting the signals we care about
+    scope : list[str] = []
+    signals : dict[str, list[VcdSignal]] = {}
+    for line in infile:
+        fields = line.split()
+        if not fields:
+            continue
+        if fields[0] == '$scope':
+            scope.append(fields[2])
+        elif fields[0] == '$upscope':
+            scope.pop()
+        elif fields[0] == '$var':
+            # $var wire 16 # pc [15:0] $end
+            signals.setdefault(fields[3], []).append(VcdSignal(fields[4], '.'.join(scope), int(fields[2])))
+        elif fields[0] == '$enddefinitions':
+            break
+
+    # find the cpu, the first scope with all of the signals we need
+    wanted = [ 'clk', 'rst', 'state', 'pc', 'ir' ]
+    scopes : dict[str, dict[str, str]] = {}
+    for ident, sigs in signals.items():
+        for s in sigs:
+            if s.name in wanted:
+                scopes.setdefault(s.scope, {}).setdefault(s.name, ident)
+    codes = None
+    for name in sorted(scopes, key=len):
+        if cpu_scope and not name.endswith(cpu_scope):
+            continue
+        if len(scopes[name]) == len(wanted):
+            codes = scopes[name]
+            break
+    if codes is None:
+        raise TraceError("could not find a scope with signals %s" % ', '.join(wanted))
+
+    clk_id = codes['clk']
+    ids = { codes[n]: n for n in wanted }
+    values : dict[str, int | None] = { n: None for n in wanted }
+    changes : dict[str, int | None] = {}
+
+    # the instruction currently occupying stage 2
+    cur_pc = -1
+
+    def end_timestep():
+        nonlocal cur_pc
+        # rising edge, account for the cycle that just ended
+        if changes.get('clk') == 1 and values['clk'] == 0 and values['rst'] == 0:
+            state = values['state']
+            name = CPU_STATES[state] if state is not None and state < len(CPU_STATES) else 'UNKNOWN'
+            stats.cycles += 1
+            stats.states[name] += 1
+
+            ir = values['ir'] or 0
+            if name == 'DECODE' and values['pc'] is not None:
+                # pc has already moved on to the following word
+                cur_pc = (values['pc'] - 1) & 0xffff
+                if ir == 0:
+                    # nop or pipeline bubble, don't charge it to anyone
+                    stats.bubbles += 1
+                    cur_pc = -1
+                else:
+                    stats.instructions += 1
+                    stats.fetches[cur_pc] += 1
+            if cur_pc >= 0:
+                stats.pc_cycles[cur_pc] += 1
+                if name == 'LS1':
+                    if ir >> 11 == OP_LOAD:
+                        stats.loads[cur_pc] += 1
+                    elif ir >> 11 == OP_STORE:
+                        stats.stores[cur_pc] += 1
+        values.update(changes)
+        changes.clear()
+
+    for line in infile:
+        line = line.strip()
+        if not line:
+            continue
+        c = line[0]
+        if c == '#':
+            end_timestep()
+        elif c in 'bB':
+            val, ident = line[1:].split()
+            if ident in ids:
+                changes[ids[ident]] = vcd_value(val)
+        elif c in '01xXzZ':
+            ident = line[1:]
+            if ident in ids:
+                changes[ids[ident]] = vcd_value(c)
+        # $dumpvars, $end, real values and the like are ignored
+    end_timestep()
+
+    return stats
+
+def print_report(stats : TraceStats, sym : Symbolizer, top : int, outfile = sys.stdout):
+    out = outfile
+    print("cycles %d" % stats.cycles, file=out)
+    if stats.instructions:
+        if stats.states:
+            print("instructions %d (plus %d nops/pipeline bubbles)" % (stats.instructions, stats.bubbles), file=out)
+        else:
+            print("instructions %d, counted from fetches of their first word" % stats.instructions, file=out)
+        print("IPC %.3f, CPI %.3f" % (stats.instructions / max(stats.cycles, 1),
+              stats.cycles / stats.instructions), file=out)
+    if not stats.states:
+        print("fetches %d, loads %d, stores %d" % (sum(stats.fetches.values()),
+              sum(stats.loads.values()), sum(stats.stores.values())), file=out)
+        if stats.fetches:
+            print("fetch words per cycle %.3f" % (sum(stats.fetches.values()) / max(stats.cycles, 1)), file=out)
+
+    if stats.states:
+        print("\nstate breakdown:", file=out)
+        for name in CPU_STATES + [ 'UNKNOWN' ]:
+            if name in stats.states:
+                n = stats.states[name]
+                print("  %-13s %12d %6.2f%%" % (name, n, 100.0 * n / stats.cycles), file=out)
+
+    def section(title : str, counts : Counter[int]):
+        if not counts:
+            return
+        total = sum(counts.values())
+        print("\n%s:" % title, file=out)
+        print("  %-6s %12s %7s  %-20s %-20s %s" % ("addr", "count", "pct", "symbol", "source", "text"), file=out)
+        for addr, n in counts.most_common(top):
+            print("  0x%04x %12d %6.2f%%  %-20s %-20s %s" % (addr, n, 100.0 * n / total,
+                  sym.symbol(addr), sym.location(addr), sym.text(addr)), file=out)
+
+    if stats.pc_cycles:
+        section("hot spots by cycles", stats.pc_cycles)
+        section("hot spots by executions", stats.fetches)
+        section("loads by pc", stats.loads)
+        section("stores by pc", stats.stores)
+    else:
+        section("hot spots by fetches", stats.fetches)
+        section("loads by address", stats.loads)
+        section("stores by address", stats.stores)
+
+def main():
+    parser = argparse.ArgumentParser(description="summarize a MEMTRACE log or vcd dump from the simulator")
+    parser.add_argument('trace', nargs='?', type=argparse.FileType('r'), default=sys.stdin, help="trace file")
+    parser.add_argument('-s','--source', nargs=1, type=argparse.FileType('r'), help="assembly source the image was built from")
+    parser.add_argument('--gc', nargs='?', const='start', metavar='ENTRY', help="the image was built with --gc")
+    parser.add_argument('--opt-branches', action='store_true', help="the image was built with --opt-branches")
+    parser.add_argument('--hoist-loops', action='store_true', help="the image was built with --hoist-loops")
+    parser.add_argument('-f','--format', choices=[ 'auto', 'memtrace', 'vcd' ], default='auto', help="trace format")
+    parser.add_argument('--scope', default="", help="vcd scope of the cpu, e.g. testbench.cpu0")
+    parser.add_argument('-n','--top', type=int, default=20, help="number of hot spots to list")
+
+    args = parser.parse_args()
+
+    if args.source is None and (args.gc is not None or args.opt_branches or args.hoist_loops):
+        parser.error("--gc, --opt-branches and --hoist-loops need --source")
+
+    code = None
+    if args.source is not None:
+        # the passes report what they did, keep that out of the trace report
+        with contextlib.redirect_stdout(sys.stderr):
+            code = asm.assemble(args.source[0], gc_entry=args.gc, opt_branches=args.opt_branches, hoist_loops=args.hoist_loops)
+    sym = Symbolizer(code)
+
+    infile = args.trace
+    fmt = args.format
+    if fmt == 'auto':
+        # peek at the first line without consuming the stream
+        first = infile.readline()
+        fmt = 'vcd' if first.lstrip().startswith('$') else 'memtrace'
+        infile = chain_first(first, infile)
+
+    if fmt == 'vcd':
+        stats = parse_vcd(infile, sym, args.scope)
+    else:
+        stats = parse_memtrace(infile, sym)
+
+    print_report(stats, sym, args.top)
+
+def chain_first(first : str, infile):
+    yield first
+    yield from infile
+
+if __name__ == "__main__":
+    main()
+
+# vim: ts=4 sw=4 expandtab:
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+
+# symbol and source line map
+#
+# written next to the image so profilers, trace viewers and the like can turn
+# addresses back into names without reassembling. the file is a set of flat
+# sorted columns that can be mmapped and binary searched in place.
+#
+# all fields are little endian 32 bit words, matching the host tools that
+# read it rather than the target:
+#
+# header (7 words):
+#   magic           '2MAP'
+#   version         1
+#   image words     length of the image in words
+#   nsyms           number of symbols
+#   nlines          number of line table entries
+#   nfiles          number of file names
+#   strtab size     size of the string table in bytes
+#
+# columns, in order:
+#   sym_addr[nsyms]     symbol addresses, sorted ascending
+#   sym_name[nsyms]     string table offsets of the symbol names
+#   line_addr[nlines]   first address of each line entry, sorted ascending.
+#                       an entry covers up to the next entry's address.
+#   line_file[nlines]   index into file_name
+#   line_line[nlines]   source line number
+#   file_name[nfiles]   string table offsets of the file names
+#
+# string table:
+#   nul terminated utf-8 strings
+
+import argparse
+import array
+import bisect
+import mmap
+import struct
+import sys
+
+MAP_MAGIC = b'2MAP'
+MAP_VERSION = 1
+
+HEADER = struct.Struct('<4s6I')
+
+class MapError(Exception):
+    pass
+
+def _column(values) -> bytes:
+    col = array.array('I', values)
+    if sys.byteorder == 'big':
+        col.byteswap()
+    return col.tobytes()
+
+# write the map for an assembled program
+def write_map(code, outfile):
+    strtab = bytearray()
+    strings : dict[str, int] = {}
+
+    def intern(s : str) -> int:
+        if s not in strings:
+            strings[s] = len(strtab)
+            strtab.extend(s.encode('utf-8') + b'\0')
+        return strings[s]
+
+    syms = sorted((s.addr, s.name) for s in code.symbols.values() if s.resolved)
+    sym_addr = [ s[0] for s in syms ]
+    sym_name = [ intern(s[1]) for s in syms ]
+
+    files : dict[str, int] = {}
+    line_addr : list[int] = []
+    line_file : list[int] = []
+    line_line : list[int] = []
+    for out in code.output:
+        if out.line == 0 or out.length == 0:
+            continue
+        f = files.setdefault(out.file, len(files))
+
+        # fold runs of output generated by the same line, e.g. macros
+        if line_addr and line_file[-1] == f and line_line[-1] == out.line:
+            continue
+        line_addr.append(out.addr)
+        line_file.append(f)
+        line_line.append(out.line)
+
+    file_name = [ intern(name) for name in files ]
+
+    outfile.write(HEADER.pack(MAP_MAGIC, MAP_VERSION, code.cur_addr,
+                              len(sym_addr), len(line_addr), len(file_name), len(strtab)))
+    for col in (sym_addr, sym_name, line_addr, line_file, line_line, file_name):
+        outfile.write(_column(col))
+    outfile.write(strtab)
+
+class SymbolMap:
+    def __init__(self, data) -> None:
+        self.data = memoryview(data)
+        if len(self.data) < HEADER.size:
+            raise MapError("map file too short")
+
+        magic, version, self.image_words, nsyms, nlines, nfiles, strtab_size = HEADER.unpack_from(self.data)
+        if magic != MAP_MAGIC:
+            raise MapError("bad map file magic")
+        if version != MAP_VERSION:
+            raise MapError("unsupported map file version %d" % version)
+
+        sizes = [ nsyms, nsyms, nlines, nlines, nlines, nfiles ]
+        if len(self.data) != HEADER.size + 4 * sum(sizes) + strtab_size:
+            raise MapError("map file size does not match header")
+
+        cols = []
+        pos = HEADER.size
+        for n in sizes:
+            col = self.data[pos:pos + 4 * n]
+            if sys.byteorder == 'big':
+                # can't use the mapping in place, take a swapped copy
+                a = array.array('I', col)
+                a.byteswap()
+                cols.append(a)
+            else:
+                cols.append(col.cast('I'))
+            pos += 4 * n
+
+        self.sym_addr, self.sym_name, self.line_addr, self.line_file, self.line_line, self.file_name = cols
+        self.strtab = self.data[pos:]
+        self.cache : dict[int, str] = {}
+
+    @classmethod
+    def open(cls, path : str) -> 'SymbolMap':
+        with open(path, 'rb') as f:
+            if f.seek(0, 2) == 0:
+                raise MapError("map file too short")
+            return cls(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def string(self, offset : int) -> str:
+        try:
+            return self.cache[offset]
+        except KeyError:
+            end = offset
+            while self.strtab[end] != 0:
+                end += 1
+            s = bytes(self.strtab[offset:end]).decode('utf-8')
+            self.cache[offset] = s
+            return s
+
+    # nearest symbol at or before addr, as (name, offset)
+    def lookup(self, addr : int) -> tuple[str, int] | None:
+        i = bisect.bisect_right(self.sym_addr, addr) - 1
+        if i < 0 or addr >= self.image_words:
+            return None
+        return (self.string(self.sym_name[i]), addr - self.sym_addr[i])
+
+    # source location of addr, as (file, line)
+    def source(self, addr : int) -> tuple[str, int] | None:
+        i = bisect.bisect_right(self.line_addr, addr) - 1
+        if i < 0 or addr >= self.image_words:
+            return None
+        return (self.string(self.file_name[self.line_file[i]]), self.line_line[i])
+
+    # 'name+0x10 (file:line)' style description of addr
+    def describe(self, addr : int) -> str:
+        s = ""
+        sym = self.lookup(addr)
+        if sym is not None:
+            s = sym[0] if sym[1] == 0 else "%s+%#x" % sym
+        src = self.source(addr)
+        if src is not None:
+            s += " (%s:%d)" % src
+        return s.strip()
+
+def main():
+    parser = argparse.ArgumentParser(description="look up addresses in a map file generated by asm.py -m")
+    parser.add_argument('map', help="map file")
+    parser.add_argument('addr', nargs='*', help="addresses to look up, all symbols if none")
+
+    args = parser.parse_args()
+
+    m = SymbolMap.open(args.map)
+    if not args.addr:
+        for i in range(len(m.sym_addr)):
+            print("0x%04x %s" % (m.sym_addr[i], m.string(m.sym_name[i])))
+    for a in args.addr:
+        addr = int(a, 0)
+        print("0x%04x %s" % (addr, m.describe(addr)))
+
+if __name__ == "__main__":
+    main()
+
+# vim: ts=4 sw=4 expandtab:
@@ -0,0 +1,114 @@
+# tests for branchopt.py, run with pytest. the fixture sources are run by test_fixtures.py
+
+import random
+
+import codegen
+
+CONDS = [ 'beq', 'bne', 'bcs', 'bcc', 'bmi', 'bpl', 'bvs', 'bvc', 'bhi', 'bls', 'bge', 'blt', 'bgt', 'ble' ]
+
+def signed(value : int, bits : int) -> int:
+    value &= (1 << bits) - 1
+    return value - (1 << bits) if value & (1 << (bits - 1)) else value
+
+# does condition code cc pass with flags, a 4 bit NZCV value
+def condition(cc : int, flags : int) -> bool:
+    n, z, c, v = flags >> 3 & 1, flags >> 2 & 1, flags >> 1 & 1, flags & 1
+    return [ z, not z, c, not c, n, not n, v, not v, c and not z, not c or z,
+             n == v, n != v, not z and n == v, z or n != v, True, False ][cc]
+
+# where control ends up after each instruction that isn't a branch, for each
+# of the 16 flag values, following any branches in between. the result is the
+# source line of the next instruction that isn't a branch, or where a call or a
+# branch through a register goes
+def control_flow(code : codegen.Codegen) -> dict[int, list[tuple]]:
+    at = { out.addr: out for out in code.output }
+
+    def follow(addr : int, flags : int, depth : int = 0) -> tuple:
+        seen = set()
+        while addr not in seen:
+            seen.add(addr)
+            out = at.get(addr)
+            if out is None:
+                return ('off',)
+            if not isinstance(out, codegen.Instruction) or out.op >> 14 != 0b10:
+                return ('line', out.line)
+            cc = (out.op >> 10) & 0xf
+            if cc != 0b1111:
+                addr = addr + 1 + signed(out.op, 10) if condition(cc, flags) else addr + 1
+            elif out.op & 0xf != 0:
+                return ('register', out.op & 0x1ff)
+            elif out.op & (1 << 9):
+                if depth > 4:
+                    return ('deep',)
+                return ('call', follow(addr + 2 + signed(out.op2, 16), flags, depth + 1),
+                        follow(addr + 2, flags, depth + 1))
+            else:
+                addr = addr + 2 + signed(out.op2, 16)
+        return ('loop',)
+
+    flow = { 0: [ follow(0, f) for f in range(16) ] }
+    for out in code.output:
+        if not isinstance(out, codegen.Instruction) or out.op >> 14 != 0b10:
+            flow[out.line] = [ follow(out.addr + out.length, f) for f in range(16) ]
+    return flow
+
+def random_program(rng : random.Random) -> str:
+    n = rng.randrange(3, 25)
+    names = [ 'start' ] + [ 'L%d' % i for i in range(1, n) ]
+    lines = []
+    for i, name in enumerate(names):
+        lines.append(name + ':')
+        # empty regions make labels that alias the next one
+        if i and rng.random() < 0.2:
+            continue
+        lines.append('    mov r5, %d' % i)
+        for _ in range(rng.randrange(0, 3)):
+            lines.append('    add r1, %d' % rng.randrange(1, 7))
+        k = rng.random()
+        if k < 0.25:
+            lines.append('    b %s' % rng.choice(names))
+        elif k < 0.45:
+            lines.append('    %s %s' % (rng.choice(CONDS), rng.choice(names)))
+            lines.append('    b %s' % rng.choice(names))
+        elif k < 0.6:
+            lines.append('    %s %s' % (rng.choice(CONDS), rng.choice(names)))
+        elif k < 0.7 and i + 1 < n:
+            # skip over a b to the next label, for inversion
+            lines.append('    %s %s' % (rng.choice(CONDS), names[i + 1]))
+            lines.append('    b %s' % rng.choice(names))
+        elif k < 0.8:
+            lines.append('    bl %s' % rng.choice(names))
+        elif k < 0.85:
+            lines.append('    b lr')
+    lines.append('    b start')
+    return '\n'.join(lines) + '\n'
+
+def check_control_flow(plain : codegen.Codegen, optimized : codegen.Codegen):
+    before = control_flow(plain)
+    after = control_flow(optimized)
+    assert set(after) == set(before)
+    for line in before:
+        assert after[line] == before[line], "control flow after line %d changed" % line
+
+def test_fixture_control_flow(assemble, src_files, fixture_sources):
+    for path in src_files + fixture_sources('branchopt'):
+        check_control_flow(assemble(path), assemble(path, opt_branches=True))
+
+def test_random_programs_keep_control_flow(assemble):
+    changed = 0
+    for seed in range(300):
+        text = random_program(random.Random(seed))
+        plain = assemble('random.asm', text)
+        optimized = assemble('random.asm', text, opt_branches=True)
+        check_control_flow(plain, optimized)
+        if optimized.image() != plain.image():
+            changed += 1
+    # make sure the pass actually had something to do
+    assert changed > 150
+
+def test_numeric_branch_is_left_alone(assemble, to_hex, fixture_sources, capsys):
+    path = fixture_sources('branchopt', 'numeric_branch')[0]
+    assert to_hex(assemble(path, opt_branches=True)) == to_hex(assemble(path))
+    assert "0 blocks moved" in capsys.readouterr().out
+
+# vim: ts=4 sw=4 expandtab:
@@ -0,0 +1,20 @@
+# fixture sources for the assembler passes, run with pytest. see conftest.py
+
+import pytest
+
+import codegen
+
+def test_fixture(pass_fixture, assemble, to_hex):
+    path, options = pass_fixture
+    base = path[:-4]
+    try:
+        with open(base + '.err') as f:
+            expected = f.read().strip()
+    except FileNotFoundError:
+        with open(base + '.hex') as f:
+            assert to_hex(assemble(path, **options)) == f.read()
+    else:
+        with pytest.raises(codegen.Codegen_Exception, match=expected):
+            assemble(path, **options)
+
+# vim: ts=4 sw=4 expandtab:
@@ -0,0 +1,102 @@
+# tests for Codegen.gc, run with pytest. the fixture sources are run by test_fixtures.py
+
+import bisect
+import random
+
+import pytest
+
+import codegen
+
+def signed(value : int, bits : int) -> int:
+    value &= (1 << bits) - 1
+    return value - (1 << bits) if value & (1 << (bits - 1)) else value
+
+# where each branch and address reference in an assembled program points, by the
+# source line it's on: the line of the output it lands in and the offset into
+# that, or None if it lands outside the program
+def references(code : codegen.Codegen) -> dict[int, tuple[int, int] | None]:
+    starts = [ out.addr for out in code.output ]
+
+    def locate(addr : int) -> tuple[int, int] | None:
+        i = bisect.bisect_right(starts, addr) - 1
+        if i < 0 or addr >= code.output[i].addr + code.output[i].length:
+            return None
+        return (code.output[i].line, addr - code.output[i].addr)
+
+    refs = {}
+    for out in code.output:
+        target = None
+        if isinstance(out, codegen.Data):
+            if out.fixup_type == codegen.FIXUP_TYPE.DATA_SYMBOL_LONG:
+                target = out.data[0]
+        elif out.op >> 14 == 0b10:
+            if (out.op >> 10) & 0xf != 0b1111:
+                target = out.addr + 1 + signed(out.op, 10)
+            elif out.op & 0xf == 0 and out.length == 2:
+                target = out.addr + 2 + signed(out.op2, 16)
+        elif out.fixup_type == codegen.FIXUP_TYPE.SYMBOL_LONG:
+            target = out.op2
+        if target is not None:
+            refs[out.line] = locate(target & 0xffff)
+    return refs
+
+# gc may only drop code, everything that's left has to point where it did before
+def check_references(plain : codegen.Codegen, collected : codegen.Codegen):
+    before = references(plain)
+    after = references(collected)
+    assert set(after) <= set(before)
+    for line, target in after.items():
+        assert target == before[line], "reference on line %d moved" % line
+
+def random_program(rng : random.Random) -> str:
+    n = rng.randrange(3, 12)
+    names = [ 'start' ] + [ 'L%d' % i for i in range(1, n) ]
+    lines = []
+    for name in names:
+        lines.append(name + ':')
+        for _ in range(rng.randrange(0, 4)):
+            k = rng.random()
+            target = rng.choice(names)
+            if k < 0.3:
+                lines.append('    add r1, 1')
+            elif k < 0.45:
+                lines.append('    bl %s' % target)
+            elif k < 0.55:
+                lines.append('    mov r2, %s' % target)
+            elif k < 0.7:
+                lines.append('    beq %s' % target)
+            else:
+                lines.append('    beq %d' % rng.randrange(-4, 8))
+        lines.append(rng.choice([ '    b %s' % rng.choice(names), '    b lr', '    add r1, 2' ]))
+    lines += [ 'table:', '.word %s' % rng.choice(names), '.word 0' ]
+    return '\n'.join(lines) + '\n'
+
+def test_fixture_references(assemble, src_files, fixture_sources):
+    for path in src_files + [ p for p in fixture_sources('gc') if not p.endswith('jump_over.asm') ]:
+        check_references(assemble(path), assemble(path, gc_entry='start'))
+
+def test_random_programs_keep_references(assemble):
+    removed = 0
+    for seed in range(300):
+        text = random_program(random.Random(seed))
+        plain = assemble('random.asm', text)
+        try:
+            collected = assemble('random.asm', text, gc_entry='start')
+        except codegen.Codegen_Exception as e:
+            assert "jumps over unreferenced code" in str(e)
+            continue
+        check_references(plain, collected)
+        if len(collected.output) < len(plain.output):
+            removed += 1
+    # make sure gc actually had something to do
+    assert removed > 150
+
+def test_nothing_dead_is_unchanged(assemble, to_hex, fixture_sources):
+    path = fixture_sources('gc', 'nothing_dead')[0]
+    assert to_hex(assemble(path, gc_entry='start')) == to_hex(assemble(path))
+
+def test_missing_entry(assemble):
+    with pytest.raises(codegen.Codegen_Exception, match="entry symbol 'main' not found"):
+        assemble('missing.asm', 'start:\n    b start\n', gc_entry='main')
+
+# vim: ts=4 sw=4 expandtab:
@@ -0,0 +1,84 @@
+# round trip tests for imagepatch.py, run with pytest
+
+import array
+import random
+
+import pytest
+
+import imagepatch
+
+def words(values) -> array.array:
+    return array.array('H', values)
+
+def random_image(rng : random.Random, length : int) -> array.array:
+    return words(rng.randrange(0x10000) for _ in range(length))
+
+def round_trip(old : array.array, new : array.array) -> bytes:
+    patch = imagepatch.make_patch(old, new)
+    assert imagepatch.apply_patch(old, patch) == new
+    return patch
+
+def test_same_size():
+    rng = random.Random(1)
+    old = random_image(rng, 1000)
+    new = array.array('H', old)
+    for addr in (0, 1, 2, 500, 501, 999):
+        new[addr] ^= 0x1234
+    round_trip(old, new)
+
+def test_identical():
+    old = random_image(random.Random(2), 300)
+    patch = round_trip(old, array.array('H', old))
+    assert len(patch) == imagepatch.HEADER_WORDS * 2
+
+def test_grow():
+    rng = random.Random(3)
+    old = random_image(rng, 100)
+    round_trip(old, old + random_image(rng, 400))
+
+def test_shrink():
+    old = random_image(random.Random(4), 500)
+    round_trip(old, old[:123])
+
+def test_empty():
+    old = random_image(random.Random(5), 64)
+    round_trip(old, words([]))
+    round_trip(words([]), old)
+    round_trip(words([]), words([]))
+
+def test_full_address_space():
+    rng = random.Random(6)
+    full = random_image(rng, 0x10000)
+    round_trip(words([]), full)
+    round_trip(full, words([]))
+    round_trip(full[:100], full)
+
+def test_fill_runs():
+    old = words([ 0x1111 ] * 100000)[:0x10000]
+    new = words([ 0 ] * 40000 + [ 0xabcd ] * 20000 + [ 5 ])
+    patch = round_trip(old, new)
+    # long runs come out as a handful of fill records, not copies
+    assert len(patch) < 100
+
+def test_random_edits():
+    rng = random.Random(7)
+    for _ in range(50):
+        old = random_image(rng, rng.randrange(0, 2000))
+        new = array.array('H', old[:rng.randrange(0, len(old) + 1)])
+        new.extend(random_image(rng, rng.randrange(0, 500)))
+        for _ in range(rng.randrange(0, 20)):
+            if new:
+                addr = rng.randrange(len(new))
+                run = rng.randrange(1, 50)
+                new[addr:addr + run] = words([ rng.randrange(4) ] * len(new[addr:addr + run]))
+        round_trip(old, new)
+
+def test_rejects_bad_patch():
+    old = words([ 1, 2, 3 ])
+    patch = imagepatch.make_patch(old, words([ 1, 5, 3 ]))
+    with pytest.raises(imagepatch.PatchError):
+        imagepatch.apply_patch(old, patch[:-2])
+    with pytest.raises(imagepatch.PatchError):
+        imagepatch.apply_patch(old, b'\0\0' + patch[2:])
+
+# vim: ts=4 sw=4 expandtab:
@@ -0,0 +1,261 @@
+# tests for loopopt.py, run with pytest. the fixture sources are run by test_fixtures.py
+
+import random
+
+import pytest
+
+import codegen
+
+# sources the pass has to leave alone, and the reason it gives
+SKIPPED = {
+    'numeric_branch': "pc relative branch with an immediate offset at 0x0005",
+    'write_lr': "write to lr or pc at 0x0005",
+    'write_pc': "write to lr or pc at 0x0005",
+}
+
+OP_STR = 0b01101
+
+def signed(value : int, bits : int) -> int:
+    value &= (1 << bits) - 1
+    return value - (1 << bits) if value & (1 << (bits - 1)) else value
+
+def is_branch(out : codegen.OutputData) -> bool:
+    return isinstance(out, codegen.Instruction) and out.op >> 14 == 0b10
+
+# the registers an alu instruction reads and the one it writes, r0 and the special registers left out
+def alu_regs(out : codegen.OutputData) -> tuple[set[int], int | None]:
+    if not isinstance(out, codegen.Instruction) or is_branch(out):
+        return (set(), None)
+    d, a, mode = (out.op >> 8) & 7, (out.op >> 5) & 7, (out.op >> 3) & 3
+    d_special = mode == 3 and out.op & 2
+    a_special = mode == 3 and out.op & 1
+    reads = set()
+    if not a_special:
+        reads.add(a)
+    if mode == 2:
+        reads.add(out.op & 7)
+    if out.op >> 11 == OP_STR and not d_special:
+        reads.add(d)
+    write = None if d_special or out.op >> 11 == OP_STR else d
+    return (reads - { 0 }, write or None)
+
+# the value a two word alu instruction carries in its immediate
+def immediate(out : codegen.OutputData):
+    if out.fixup_type == codegen.FIXUP_TYPE.SYMBOL_LONG:
+        return out.fixup_sym.name # type: ignore
+    return out.op2
+
+def call_target(out : codegen.OutputData) -> int | None:
+    if is_branch(out) and out.op & 0x3e0f == 0x3e00:
+        return out.addr + 2 + signed(out.op2, 16)
+    return None
+
+# reaching definitions for r1-r7 at every output. a definition is named by
+# def_name(out), 'entry' for whatever the register held at reset, and ('in', r)
+# for what it held when the function around it was called. calls go through a
+# summary of what the callee leaves in each register at its b lr, so values
+# only come back to the call they went in from.
+#
+# returns the state at each output, and for each function the registers it
+# reads before writing them, which count as read by every call to it
+def reaching(code : codegen.Codegen, def_name) -> tuple[dict[int, list[frozenset]], dict[int, set[int]]]:
+    at = { out.addr: out for out in code.output }
+    entries = { 0 } | { t for t in map(call_target, code.output) if t is not None }
+
+    def successors(out : codegen.OutputData) -> list[int]:
+        if not is_branch(out):
+            return [ out.addr + out.length ]
+        cc = (out.op >> 10) & 0xf
+        if cc < 0b1110:
+            return [ out.addr + 1, out.addr + 1 + signed(out.op, 10) ]
+        if cc == 0b1110:
+            return [ out.addr + 1 + signed(out.op, 10) ]
+        if out.op & 0xf == 0:
+            return [ out.addr + 2 + signed(out.op2, 16) ]
+        assert out.op & 0x20f == 0b1000, "branch through a register other than b lr at 0x%04x" % out.addr
+        return []
+
+    summaries : dict[int, list[frozenset]] = {}
+
+    def analyze(entry : int) -> tuple[dict[int, list[frozenset]], list[frozenset] | None]:
+        if entry == 0:
+            local = { 0: [ frozenset([ 'entry' ]) ] * 8 }
+        else:
+            local = { entry: [ frozenset([ ('in', r) ]) for r in range(8) ] }
+        exits = None
+        work = [ entry ]
+        while work:
+            addr = work.pop()
+            out = at.get(addr)
+            if out is None:
+                continue
+            regs = list(local[addr])
+            target = call_target(out)
+            if target is not None:
+                if target not in summaries:
+                    continue
+                regs = [ frozenset(v for d in summaries[target][r] for v in (regs[r] if d == ('in', r) else [ d ]))
+                         for r in range(8) ]
+                succs = [ addr + 2 ]
+            else:
+                write = alu_regs(out)[1]
+                if write is not None:
+                    regs[write] = frozenset([ def_name(out) ])
+                succs = successors(out)
+                if is_branch(out) and not succs:
+                    exits = regs if exits is None else [ a | b for a, b in zip(exits, regs) ]
+            for succ in succs:
+                old = local.get(succ)
+                new = regs if old is None else [ a | b for a, b in zip(old, regs) ]
+                if new != old:
+                    local[succ] = new
+                    work.append(succ)
+        return (local, exits)
+
+    # callees summarize to more and more as their own callees do, until nothing changes
+    changed = True
+    while changed:
+        changed = False
+        locals_ = {}
+        for entry in sorted(entries):
+            locals_[entry], exits = analyze(entry)
+            if exits is not None and exits != summaries.get(entry):
+                summaries[entry] = exits
+                changed = True
+
+    exposed : dict[int, set[int]] = { entry: set() for entry in entries }
+    changed = True
+    while changed:
+        changed = False
+        for entry, local in locals_.items():
+            for addr, regs in local.items():
+                if addr not in at:
+                    continue
+                target = call_target(at[addr])
+                reads = exposed.get(target, set()) if target is not None else alu_regs(at[addr])[0]
+                for r in reads:
+                    if ('in', r) in regs[r] and r not in exposed[entry]:
+                        exposed[entry].add(r)
+                        changed = True
+
+    state : dict[int, list[frozenset]] = {}
+    for local in locals_.values():
+        for addr, regs in local.items():
+            state[addr] = regs if addr not in state else [ a | b for a, b in zip(state[addr], regs) ]
+    return (state, exposed)
+
+# hoisting may only add loads of constants, and point uses at them. every
+# register an original instruction reads has to see the same definitions as
+# without hoisting, and a rewritten use only the load of its own value
+def check_hoisting(plain : codegen.Codegen, hoisted : codegen.Codegen) -> int:
+    # the pass puts its loads on the line of the loop's first instruction, in front of it
+    inserted : dict[int, tuple] = {}
+    for i, out in enumerate(hoisted.output):
+        if i + 1 < len(hoisted.output) and hoisted.output[i + 1].line == out.line:
+            assert out.string.startswith('mov ') and out.length == 2
+            inserted[out.addr] = ((out.op >> 8) & 7, immediate(out))
+    if not inserted:
+        assert hoisted.image() == plain.image()
+        return 0
+
+    originals = [ out for out in hoisted.output if out.addr not in inserted ]
+    assert [ o.line for o in originals ] == [ o.line for o in plain.output ]
+
+    rewritten : dict[int, tuple] = {}
+    for p, h in zip(plain.output, originals):
+        if is_branch(p) or isinstance(p, codegen.Data):
+            assert h.string.split()[0] == p.string.split()[0]
+        elif p.length == 2 and h.length == 1:
+            # op d, a, imm became op d, a, rN
+            assert p.op & 0x1f == 0b11100 and h.op & ~0x7 == (p.op & ~0x1f) | 0b10000
+            rewritten[h.addr] = (h.op & 7, immediate(p))
+        else:
+            assert (h.op, h.op2, h.string) == (p.op, p.op2, p.string) or h.fixup_sym is not None
+
+    def name(code : codegen.Codegen):
+        return lambda out: ('hoisted', inserted[out.addr]) if code is hoisted and out.addr in inserted else out.line
+
+    before, exposed_before = reaching(plain, name(plain))
+    after, exposed_after = reaching(hoisted, name(hoisted))
+    for p, h in zip(plain.output, originals):
+        if h.addr not in after:
+            continue
+        reads = alu_regs(h)[0]
+        if h.addr in rewritten:
+            reg, value = rewritten[h.addr]
+            assert after[h.addr][reg] == { ('hoisted', (reg, value)) }, "use at 0x%04x" % h.addr
+            reads = alu_regs(p)[0]
+        if call_target(p) is not None:
+            reads = exposed_before[call_target(p)] | exposed_after[call_target(h)]
+        for reg in reads:
+            assert after[h.addr][reg] == before[p.addr][reg], "r%d read at 0x%04x" % (reg, h.addr)
+    return len(rewritten)
+
+def random_program(rng : random.Random) -> str:
+    lines = [ 'start:', '    mov r6, 0x4000' ]
+    wide = [ '0x1234', '0xff', '0x8000', '0x100', '20', '-100', 'data' ]
+    labels = [ 0 ]
+    funcs = [ 'fn%d' % i for i in range(rng.randrange(0, 3)) ]
+
+    def statement(regs : list[int], depth : int, callees : list[str]):
+        r = rng.choice(regs)
+        k = rng.random()
+        if k < 0.35:
+            lines.append('    %s r%d, %s' % (rng.choice([ 'add', 'sub', 'and', 'or', 'xor', 'mov' ]), r, rng.choice(wide)))
+        elif k < 0.55:
+            lines.append('    %s r%d, r%d' % (rng.choice([ 'add', 'sub', 'and', 'xor' ]), r, rng.choice(regs)))
+        elif k < 0.7:
+            lines.append('    str r%d, r6, %s' % (r, rng.choice([ '3', '0x200' ])))
+        elif k < 0.8 and callees:
+            lines.append('    bl %s' % rng.choice(callees))
+        elif k < 0.9 and depth < 2 and len(regs) > 1:
+            loop(regs, depth + 1, callees)
+        else:
+            lines.append('    ldr r%d, r6, 0x10' % r)
+
+    def loop(regs : list[int], depth : int, callees : list[str]):
+        n = labels[0]
+        labels[0] += 1
+        counter = rng.choice(regs)
+        lines.append('    mov r%d, %d' % (counter, rng.randrange(1, 5)))
+        lines.append('loop%d:' % n)
+        for _ in range(rng.randrange(1, 5)):
+            statement([ r for r in regs if r != counter ], depth, callees)
+        lines.append('    sub r%d, 1' % counter)
+        lines.append('    bne loop%d' % n)
+
+    pool = [ 1, 2, 3, 4, 5, 7 ]
+    rng.shuffle(pool)
+    k = rng.randrange(2, 5)
+    for _ in range(rng.randrange(1, 4)):
+        statement(pool[:k], 1, funcs)
+        loop(pool[:k], 1, funcs)
+    lines += [ '    str r1, r6, 1', 'die:', '    b die' ]
+    for i, f in enumerate(funcs):
+        lines.append(f + ':')
+        regs = rng.sample(pool[k:], rng.randrange(1, len(pool) - k + 1))
+        for _ in range(rng.randrange(1, 4)):
+            statement(regs, 1, funcs[i + 1:])
+        lines.append('    b lr')
+    lines += [ 'data:', '.word 0x55' ]
+    return '\n'.join(lines) + '\n'
+
+def test_fixture_hoisting(assemble, src_files, fixture_sources):
+    for path in src_files + fixture_sources('loopopt'):
+        check_hoisting(assemble(path), assemble(path, hoist_loops=True))
+
+def test_random_programs_hoisting(assemble):
+    rewritten = 0
+    for seed in range(300):
+        text = random_program(random.Random(seed))
+        rewritten += check_hoisting(assemble('random.asm', text), assemble('random.asm', text, hoist_loops=True))
+    # make sure the pass actually had something to do
+    assert rewritten > 300
+
+@pytest.mark.parametrize('name', sorted(SKIPPED))
+def test_skipped(name : str, assemble, to_hex, fixture_sources, capsys):
+    path = fixture_sources('loopopt', name)[0]
+    assert to_hex(assemble(path, hoist_loops=True)) == to_hex(assemble(path))
+    assert "loops: nothing hoisted, %s" % SKIPPED[name] in capsys.readouterr().out
+
+# vim: ts=4 sw=4 expandtab:
@@ -0,0 +1,78 @@
+# tests for the parallel parser in asm.py, run with pytest
+#
+# parse_parallel has to give exactly what parsing the unit serially gives
+
+import io
+import os
+import random
+
+import asm
+
+def generate_unit(path : str, blocks : int = 800, duplicate : bool = False):
+    rng = random.Random(1)
+    lines = [ 'start:', '    mov sp, 0x8000', '    bl included' ]
+    for n in range(blocks):
+        lines.append('f%d:' % n)
+        lines.append('    add r1, r2, %d' % rng.randrange(16))
+        # references forward and back, far enough to cross chunk boundaries
+        lines.append('    bl f%d' % rng.randrange(blocks))
+        lines.append('    bne f%d' % min(n + rng.randrange(1, 30), blocks - 1))
+        lines.append('    mov r3, f%d' % rng.randrange(blocks))
+        lines.append('.word f%d' % rng.randrange(blocks))
+        if n == blocks // 2:
+            lines.append('#include "inc.asm"')
+        if duplicate and n in (10, blocks - 10):
+            lines.append('twice:')
+    lines.append('    b start')
+
+    with open(os.path.join(os.path.dirname(path), 'inc.asm'), 'w') as f:
+        f.write('included:\n    mov r4, f%d\n    b lr\nmessage:\n.asciiz "included"\n' % (blocks - 1))
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+# bin, hex and map output of an assembled unit
+def outputs(code) -> tuple[bytes, str, bytes]:
+    binary = io.BytesIO()
+    code.output_binary(binary)
+    hexfile = io.StringIO()
+    code.output_hex(hexfile)
+    mapfile = io.BytesIO()
+    code.output_map(mapfile)
+    return (binary.getvalue(), hexfile.getvalue(), mapfile.getvalue())
+
+def preprocess(path : str) -> list[str]:
+    return asm.Preprocessor().run(path, os.path.dirname(path))
+
+def serial(path : str, lines : list[str]):
+    with open(path) as f:
+        return asm.assemble(f, lines=list(lines), cwd=os.path.dirname(path))
+
+def test_parallel_matches_serial(tmp_path):
+    path = str(tmp_path / 'unit.asm')
+    generate_unit(path)
+    lines = preprocess(path)
+    assert len(lines) >= asm.PARALLEL_MIN_LINES
+    assert any('inc.asm' in line for line in lines)
+
+    expected = outputs(serial(path, lines))
+    for jobs in (2, 3, 4, 7):
+        code = asm.parse_parallel(lines, jobs, path)
+        assert code is not None
+        code.handle_fixups()
+        assert outputs(code) == expected, "%d jobs" % jobs
+
+def test_duplicate_label_falls_back(tmp_path, monkeypatch):
+    path = str(tmp_path / 'unit.asm')
+    generate_unit(path, duplicate=True)
+    lines = preprocess(path)
+
+    # the two definitions land in different chunks, so the pieces can't be linked
+    assert asm.parse_parallel(lines, 4, path) is None
+
+    # and assemble() parses serially instead, even with cpus to spare
+    monkeypatch.setattr(os, 'cpu_count', lambda: 4)
+    with open(path) as f:
+        code = asm.assemble(f, lines=list(lines), jobs=4)
+    assert outputs(code) == outputs(serial(path, lines))
+
+# vim: ts=4 sw=4 expandtab:
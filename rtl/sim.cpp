@@ -21,6 +21,8 @@
 */
 
 #include <sys/types.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
 #include <unistd.h>
 #include <fcntl.h>
 
@@ -53,9 +55,56 @@ void dpi_mem_read(int i, int addr, int *data)
 #endif
 }
 
+static uint32_t be32(const uint8_t *p)
+{
+    return (p[0] << 24) | (p[1] << 16) | (p[2] << 8) | p[3];
+}
+
+/* load memory from a flat image written by asm.py -F, see asm/flatimage.py */
+static int load_flat(const char *name)
+{
+    int fd = open(name, O_RDONLY);
+    if (fd < 0) {
+        fprintf(stderr, "cannot open '%s' for reading\n", name);
+        return -1;
+    }
+
+    struct stat st;
+    if (fstat(fd, &st) < 0 || st.st_size < 28) {
+        fprintf(stderr, "'%s' is too short for a flat image\n", name);
+        close(fd);
+        return -1;
+    }
+
+    const uint8_t *p = (const uint8_t *)mmap(NULL, st.st_size, PROT_READ, MAP_PRIVATE, fd, 0);
+    close(fd);
+    if (p == MAP_FAILED) {
+        fprintf(stderr, "cannot map '%s'\n", name);
+        return -1;
+    }
+
+    /* magic, version 1, and a full 64K word array */
+    uint32_t offset = be32(p + 12);
+    uint32_t words = be32(p + 16);
+    if (memcmp(p, "2IMG", 4) || p[4] != 0 || p[5] != 1 ||
+            words != 65536 || offset > st.st_size || st.st_size - offset < words * 2) {
+        fprintf(stderr, "'%s' is not a valid flat image\n", name);
+        munmap((void *)p, st.st_size);
+        return -1;
+    }
+
+    const uint8_t *image = p + offset;
+    for (uint32_t i = 0; i < words; i++)
+        memory[i] = (image[i * 2] << 8) | image[i * 2 + 1];
+
+    munmap((void *)p, st.st_size);
+    return 0;
+}
+
 int main(int argc, char **argv) {
     const char *vcdname = "sim_trace.vcd";
     const char *memname = NULL;
+    const char *flatname = NULL;
     const char *omemname = NULL;
 
     while (argc > 1) {
@@ -81,6 +130,14 @@ int main(int argc, char **argv) {
             memname = argv[2];
             argv += 2;
             argc -= 3;
+        } else if (!strcmp(argv[1], "-if")) {
+            if (argc < 3) {
+                fprintf(stderr, "error: -if requires argument\n");
+                return -1;
+            }
+            flatname = argv[2];
+            argv += 2;
+            argc -= 2;
         } else if (!strcmp(argv[1], "-om")) {
             if (argc < 2) {
                 fprintf(stderr, "error: -om requires argument\n");
@@ -117,6 +174,11 @@ int main(int argc, char **argv) {
         fclose(fp);
     }
 
+    if (flatname) {
+        if (load_flat(flatname) < 0)
+            return -1;
+    }
+
     Verilated::commandArgs(argc, argv);
     Verilated::debug(0);
     Verilated::randReset(2);